@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import asyncio
+import time
+
+from imgserve.logger import simple_logger
+
+log = simple_logger("catalogue")
+
+
+class ExperimentCatalogue:
+    """
+        In-process cache of the experiment catalogue, served stale while a refresh runs in the background.
+        The catalogue is loaded at startup, then refreshed every refresh_interval seconds, or on demand with request_refresh.
+        load is blocking (it queries Elasticsearch), so it runs in the default executor, off the event loop.
+    """
+
+    def __init__(
+        self, load: Callable[[], Dict[str, Any]], refresh_interval: float = 300
+    ) -> None:
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.loaded_at: Optional[float] = None
+        self._experiments: Optional[Dict[str, Any]] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        self._periodic: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._periodic = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self) -> None:
+        if self._periodic is not None:
+            self._periodic.cancel()
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    async def _load(self) -> Dict[str, Any]:
+        started = time.time()
+        try:
+            experiments = await asyncio.get_running_loop().run_in_executor(None, self.load)
+        except Exception as exc:
+            # keep serving the catalogue we have, the next refresh may succeed
+            log.error(f"could not refresh the experiment catalogue: {exc!r}")
+            return self._experiments if self._experiments is not None else dict()
+        self._experiments = experiments
+        self.loaded_at = time.time()
+        log.info(f"loaded {len(experiments)} experiments in {self.loaded_at - started:.2f}s")
+        return experiments
+
+    def request_refresh(self) -> asyncio.Task:
+        """ start a refresh in the background, unless one is already running, and return it """
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._load())
+        return self._refreshing
+
+    async def refresh(self) -> Dict[str, Any]:
+        """ refresh now, sharing a refresh that is already running """
+        return await self.request_refresh()
+
+    async def get(self) -> Dict[str, Any]:
+        """ the catalogue from memory, only waiting for it before the first load has finished """
+        if self._experiments is None:
+            return await self.refresh()
+        if self.loaded_at is not None and time.time() - self.loaded_at > 2 * self.refresh_interval:
+            # the periodic refresh is behind, e.g. after a failed load, serve what we have and revalidate
+            self.request_refresh()
+        return self._experiments
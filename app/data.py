@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+import asyncio
+import base64
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+
+from imgserve.api import Experiment
+from imgserve.elasticsearch import get_response_value
+from imgserve.logger import simple_logger
+from imgserve.similarity import SimilarityIndex
+
+log = simple_logger("data")
+
+
+class DataAccess:
+    """
+        Async access to the Elasticsearch, S3 and local file data the server handlers need.
+        The imgserve clients are blocking, so every call runs in starlette's threadpool, and a slow query or S3 download
+        only holds up the request that made it, instead of the whole event loop.
+    """
+
+    def __init__(
+        self,
+        elasticsearch_client: Elasticsearch,
+        s3_client: botocore.clients.s3,
+        bucket_name: str,
+        local_data_store: Path = Path("static/data"),
+        debug: bool = False,
+    ) -> None:
+        self.elasticsearch_client = elasticsearch_client
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.local_data_store = local_data_store
+        self.debug = debug
+        self._experiments: Dict[str, Experiment] = dict()
+        # similarity indexes are loaded from disk, or built, the first time an experiment is queried
+        self._similarity_indexes: Dict[Tuple[str, str], SimilarityIndex] = dict()
+        self._similarity_locks: Dict[Tuple[str, str], asyncio.Lock] = dict()
+
+    @property
+    def s3_region_name(self) -> str:
+        return self.s3_client.meta._client_config.__dict__["region_name"]
+
+    def experiment(self, name: str) -> Experiment:
+        if name not in self._experiments:
+            self._experiments[name] = Experiment(
+                bucket_name=self.bucket_name,
+                elasticsearch_client=self.elasticsearch_client,
+                local_data_store=self.local_data_store,
+                name=name,
+                s3_client=self.s3_client,
+                debug=self.debug,
+            )
+        return self._experiments[name]
+
+    async def response_values(self, **kwargs: Any) -> List[Any]:
+        """ every value get_response_value yields for kwargs """
+        return await run_in_threadpool(
+            lambda: list(
+                get_response_value(elasticsearch_client=self.elasticsearch_client, **kwargs)
+            )
+        )
+
+    async def read_bytes(self, path: Path) -> bytes:
+        return await run_in_threadpool(path.read_bytes)
+
+    async def get(self, experiment_name: str, word: str) -> List[Dict[str, Any]]:
+        """
+            Colorgram documents of word in an experiment, with their base64 encoded colorgram,
+            raising FileNotFoundError if there are none. Colorgrams missing locally are pulled from S3.
+        """
+        experiment = self.experiment(experiment_name)
+
+        def get() -> List[Dict[str, Any]]:
+            return [
+                {
+                    "doc": doc,
+                    "image_bytes": base64.b64encode(img_path.read_bytes()).decode("utf-8"),
+                }
+                for doc, img_path in experiment.get(word)
+            ]
+
+        return await run_in_threadpool(get)
+
+    async def stream(
+        self, experiment_name: str, word: str
+    ) -> AsyncGenerator[Tuple[Dict[str, Any], bytes], None]:
+        """
+            Like get, yielding each colorgram document and its image bytes as soon as it is found,
+            so a caller that stops early never pulls the rest of the colorgrams from S3.
+        """
+        results = self.experiment(experiment_name).get(word)
+        try:
+            while True:
+                result = await run_in_threadpool(next, results, None)
+                if result is None:
+                    return
+                doc, img_path = result
+                yield doc, await self.read_bytes(img_path)
+        finally:
+            results.close()
+
+    async def similarity_index(self, experiment_name: str, field: str) -> SimilarityIndex:
+        """ the similarity index of an experiment, rebuilt when the experiment's colorgram count no longer matches it """
+        key = (experiment_name, field)
+        experiment = self.experiment(experiment_name)
+        similarity_index = self._similarity_indexes.get(key)
+        if similarity_index is not None and similarity_index.colorgrams == await run_in_threadpool(lambda: experiment.total_colorgrams):
+            return similarity_index
+        # concurrent queries of a missing or stale index wait for one build
+        lock = self._similarity_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if self._similarity_indexes.get(key) is similarity_index:
+                self._similarity_indexes[key] = await run_in_threadpool(
+                    experiment.similarity_index, field=field
+                )
+        return self._similarity_indexes[key]
+
+    async def similar_words(self, experiment_name: str, field: str, word: str, k: int = 10, metric: str = "js") -> List[Dict[str, Any]]:
+        """ SimilarityIndex.similar_words, the distance computations are CPU bound """
+        similarity_index = await self.similarity_index(experiment_name, field)
+        return await run_in_threadpool(similarity_index.similar_words, word, k=k, metric=metric)
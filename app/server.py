@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import argparse
+import asyncio
 import base64
 import copy
 import csv
@@ -30,19 +31,19 @@ from starlette.responses import (
 from starlette.routing import Route, Mount, WebSocketRoute
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
-from starlette.websockets import WebSocket
+from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.cors import CORSMiddleware
 
 from imgserve import get_experiment_csv_path, STATIC, LOCAL_DATA_STORE
-from imgserve.api import Experiment
 from imgserve.args import get_elasticsearch_args, get_s3_args
 from imgserve.clients import get_clients
-from imgserve.elasticsearch import get_response_value
 from imgserve.logger import simple_logger
 
+from catalogue import ExperimentCatalogue
+from data import DataAccess
 from vectors import get_experiments
 
 log = simple_logger("api")
@@ -93,6 +94,14 @@ middleware = [
 ]
 
 app = Starlette(middleware=middleware)
+
+# every page and websocket reads the experiment catalogue from here, instead of querying Elasticsearch for it
+CATALOGUE = ExperimentCatalogue(
+    load=lambda: get_experiments(ELASTICSEARCH_CLIENT, debug=DEBUG),
+    refresh_interval=float(os.getenv("IMGSERVE_CATALOGUE_REFRESH_INTERVAL", "300")),
+)
+app.add_event_handler("startup", CATALOGUE.start)
+app.add_event_handler("shutdown", CATALOGUE.stop)
 app.mount("/static", StaticFiles(directory=STATIC), name="static")
 
 templates = Jinja2Templates(directory="templates")
@@ -142,7 +151,7 @@ async def respond_with_404(request: Request, message: str):
 async def home(request: Request):
     template = "home.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT, debug=DEBUG)
+    experiments = await CATALOGUE.get()
     results = [p.name for p in Path("static/img/colorgrams").glob("*")]
 
     context = {"request": request, "experiments": experiments, "results": results}
@@ -163,7 +172,7 @@ async def archive(request: Request):
             response = RedirectResponse(url=dl_link)
     else:
         template = "archive.html"
-        experiments = get_experiments(ELASTICSEARH_CLIENT)
+        experiments = await CATALOGUE.get()
         context = {"request": request, "experiments": experiments}
         response = templates.TemplateResponse(template, context)
 
@@ -175,7 +184,7 @@ async def archive(request: Request):
 async def search(request: Request):
     template = "search.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
+    experiments = await CATALOGUE.get()
 
     context = {"request": request, "experiments": experiments}
     return templates.TemplateResponse(template, context)
@@ -193,7 +202,7 @@ async def sketch(request: Request):
 
     template = "sketch.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
+    experiments = await CATALOGUE.get()
 
     context = {
         "request": request,
@@ -212,7 +221,7 @@ async def search(request: Request):
 
     template = "search.html"
 
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
+    experiments = await CATALOGUE.get()
 
     context = {
         "request": request,
@@ -225,39 +234,34 @@ async def search(request: Request):
 async def get_image(request: Request):
     image_id = request.query_params["image_id"]
 
-    image_urls = [
-        image_url
-        for image_url in get_response_value(
-            elasticsearch_client=ELASTICSEARCH_CLIENT,
-            index="raw-images",
-            query={
-                "query": {
-                    "bool": {
-                        "filter": {"term": {"image_id": image_id}}
-                    }
-                },
-                "aggregations": {
-                    "image_url": {
-                        "terms": {
-                            "field": "image_url",
-                            "size": 250,
-                        }
-                    }
+    image_urls = await DATA.response_values(
+        index="raw-images",
+        query={
+            "query": {
+                "bool": {
+                    "filter": {"term": {"image_id": image_id}}
                 }
             },
-            value_keys=["aggregations", "image_url", "buckets", "*", "key"],
-            size=0,
-            #debug=True,
-        )
-    ]
+            "aggregations": {
+                "image_url": {
+                    "terms": {
+                        "field": "image_url",
+                        "size": 250,
+                    }
+                }
+            }
+        },
+        value_keys=["aggregations", "image_url", "buckets", "*", "key"],
+        size=0,
+        #debug=True,
+    )
 
-    s3_region_name = S3_CLIENT.meta._client_config.__dict__["region_name"]
+    s3_region_name = DATA.s3_region_name
     s3_bucket = "compsyn"
     try:
         cropped_face_urls = [
             f"https://{s3_bucket}.s3.{s3_region_name}.amazonaws.com/{key['experiment_name']}/faces/{key['face_id']}.jpg"
-            for key in get_response_value(
-                elasticsearch_client=ELASTICSEARCH_CLIENT,
+            for key in await DATA.response_values(
                 index="cropped-face*",
                 query={
                     "query": {
@@ -295,8 +299,47 @@ async def get_image(request: Request):
     return templates.TemplateResponse(template, context)
 
 
+class WebsocketSession:
+    """
+        State of one /data connection, kept across the requests it sends: the catalogue snapshot taken when it connected
+        (or last refreshed), and a lock so replies to concurrent requests never interleave their frames.
+    """
+
+    def __init__(self, websocket: WebSocket, experiments: Dict[str, Any]) -> None:
+        self.websocket = websocket
+        self.experiments = experiments
+        self.requests = 0
+        self.send_lock = asyncio.Lock()
+
+    def reply_to(self, request: Dict[str, Any]) -> Reply:
+        return Reply(session=self, request_id=request.get("request_id"))
+
+
+class Reply:
+    """ sends the messages answering one request, tagged with its request_id when the client sent one """
+
+    def __init__(self, session: WebsocketSession, request_id: Optional[Any]) -> None:
+        self.session = session
+        self.request_id = request_id
+
+    def _tag(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        if self.request_id is not None:
+            message = dict(message, request_id=self.request_id)
+        return message
+
+    async def send_json(self, message: Dict[str, Any]) -> None:
+        async with self.session.send_lock:
+            await self.session.websocket.send_json(self._tag(message))
+
+    async def send_json_and_bytes(self, message: Dict[str, Any], data: bytes) -> None:
+        """ a JSON message immediately followed by the binary frame it describes """
+        async with self.session.send_lock:
+            await self.session.websocket.send_json(self._tag(message))
+            await self.session.websocket.send_bytes(data)
+
+
 async def valid_webhook_request(
-    websocket: WebSocket, request: Dict[str, Any], required_keys: List[str]
+    reply: Reply, request: Dict[str, Any], required_keys: List[str]
 ) -> bool:
     valid = True
     missing = list()
@@ -306,72 +349,128 @@ async def valid_webhook_request(
             missing.append(required_key)
 
     if not valid:
-        await websocket.send_json(
+        await reply.send_json(
             {"status": 400, "message": "missing required keys", "missing": missing}
         )
     return valid
 
 
+async def stream_get(
+    reply: Reply, request: Dict[str, Any], experiments: Dict[str, Any]
+) -> None:
+    """
+        Binary mode of the "get" action: each colorgram found is sent as it is found, as a JSON message with its document,
+        followed by a binary frame of its image bytes. A final JSON message with "done" set says how many were sent.
+        With single_value, stops after the first match, without syncing the colorgrams of any other experiment.
+    """
+    experiment_names = (
+        list(experiments.keys()) if request["experiment"] is None else [request["experiment"]]
+    )
+    sent = 0
+    for experiment_name in experiment_names:
+        results = DATA.stream(experiment_name, request["get"])
+        try:
+            async for doc, image_bytes in results:
+                await reply.send_json_and_bytes(
+                    {
+                        "status": 200,
+                        "doc": doc,
+                        "experiment": experiment_name,
+                        "image_bytes": len(image_bytes),
+                    },
+                    image_bytes,
+                )
+                sent += 1
+                if request["single_value"]:
+                    break
+        except FileNotFoundError as e:
+            log.info(f"no match for get request '{e}'")
+        finally:
+            await results.aclose()
+        if sent > 0 and request["single_value"]:
+            break
+
+    await reply.send_json(
+        {
+            "status": 200 if sent > 0 else 404,
+            "done": True,
+            "sent": sent,
+            "query": request["get"],
+            "experiment": request["experiment"],
+        }
+    )
+
+
 @app.websocket_route("/data")
 async def experiments_listener(websocket: WebSocket):
-    experiments = get_experiments(ELASTICSEARCH_CLIENT)
-
+    """
+        Session loop answering any number of requests on one connection.
+        Requests with a request_id are handled concurrently, and their replies carry the request_id, so they may arrive out of order.
+        Requests without one are answered in the order they were sent.
+    """
     await websocket.accept()
-    request = await websocket.receive_json()
+    session = WebsocketSession(websocket, experiments=await CATALOGUE.get())
+    in_flight = set()
+    try:
+        while True:
+            try:
+                request = await websocket.receive_json()
+            except ValueError as exc:
+                await session.reply_to(dict()).send_json(
+                    {"status": 400, "message": f"request is not JSON: {exc}"}
+                )
+                continue
+            session.requests += 1
+            if request.get("request_id") is not None:
+                task = asyncio.create_task(handle_request(session, request))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            else:
+                await handle_request(session, request)
+    except WebSocketDisconnect:
+        log.info(f"websocket session closed after {session.requests} requests")
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def handle_request(session: WebsocketSession, request: Dict[str, Any]) -> None:
+    reply = session.reply_to(request)
+    try:
+        await answer_request(reply, session, request)
+    except Exception as exc:
+        # one failed request should not end the session
+        log.exception(f"failed to answer websocket request {request}")
+        await reply.send_json({"status": 500, "message": repr(exc)})
+
+
+async def answer_request(
+    reply: Reply, session: WebsocketSession, request: Dict[str, Any]
+) -> None:
+    experiments = session.experiments
     if "single_value" not in request:
         request["single_value"] = True
 
     log.info("processing websocket request")
 
-    if await valid_webhook_request(websocket, request, required_keys=["action"]):
+    if await valid_webhook_request(reply, request, required_keys=["action"]):
         if request["action"] == "get":
             if await valid_webhook_request(
-                websocket, request, required_keys=["experiment", "get"]
+                reply, request, required_keys=["experiment", "get"]
             ):
+                if request.get("binary", False):
+                    await stream_get(reply, request, experiments)
+                    return
                 if request["experiment"] is None:
                     found = list()
                     for experiment_name in experiments.keys():
-                        experiment = Experiment(
-                            bucket_name=S3_BUCKET,
-                            elasticsearch_client=ELASTICSEARCH_CLIENT,
-                            local_data_store=Path("static/data"),
-                            name=experiment_name,
-                            s3_client=S3_CLIENT,
-                            debug=DEBUG,
-                        )
                         try:
-                            found.extend(
-                                [
-                                    {
-                                        "doc": doc,
-                                        "image_bytes": base64.b64encode(
-                                            img_path.read_bytes()
-                                        ).decode("utf-8"),
-                                    }
-                                    for doc, img_path in experiment.get(request["get"])
-                                ]
-                            )
+                            found.extend(await DATA.get(experiment_name, request["get"]))
                         except FileNotFoundError as e:
                             log.info(f"no match for get request '{e}'")
                 else:
-                    experiment = Experiment(
-                        bucket_name=S3_BUCKET,
-                        elasticsearch_client=ELASTICSEARCH_CLIENT,
-                        local_data_store=Path("static/data"),
-                        name=request["experiment"],
-                        s3_client=S3_CLIENT,
-                        debug=DEBUG,
-                    )
                     try:
-                        found = [
-                            {
-                                "doc": doc,
-                                "image_bytes": base64.b64encode(
-                                    img_path.read_bytes()
-                                ).decode("utf-8"),
-                            }
-                            for doc, img_path in experiment.get(request["get"])
-                        ]
+                        found = await DATA.get(request["experiment"], request["get"])
                     except FileNotFoundError as e:
                         log.info(f"no match for get request '{e}'")
                         found = list()
@@ -389,47 +488,76 @@ async def experiments_listener(websocket: WebSocket):
                         "experiment": request["experiment"],
                     }
                 log.info(f"sending JSON response through websocket with keys: {resp.keys()}")
-                await websocket.send_json(resp)
+                await reply.send_json(resp)
+
+        elif request["action"] == "similar":
+            if await valid_webhook_request(
+                reply, request, required_keys=["experiment", "word"]
+            ):
+                field = request.get("field", "jzazbz_dist")
+                try:
+                    similar = await DATA.similar_words(
+                        request["experiment"],
+                        field,
+                        request["word"],
+                        k=max(1, int(request.get("k", 10))),
+                        metric=request.get("metric", "js"),
+                    )
+                    resp = {
+                        "status": 200,
+                        "similar": similar[0]["similar"] if request["single_value"] else similar,
+                    }
+                except KeyError:
+                    resp = {
+                        "status": 404,
+                        "message": "no colorgram for search term",
+                        "query": request["word"],
+                        "experiment": request["experiment"],
+                    }
+                except ValueError as exc:
+                    resp = {"status": 400, "message": str(exc)}
+                await reply.send_json(resp)
 
         elif request["action"] == "list_experiments":
-            await websocket.send_json(
+            await reply.send_json(
+                {"status": 200, "experiments": list(experiments.keys())}
+            )
+        elif request["action"] == "refresh_experiments":
+            experiments = session.experiments = await CATALOGUE.refresh()
+            await reply.send_json(
                 {"status": 200, "experiments": list(experiments.keys())}
             )
         elif request["action"] == "list_image_urls":
-            image_urls = [
-                image_url
-                for image_url in get_response_value(
-                    elasticsearch_client=ELASTICSEARCH_CLIENT,
-                    index="raw-images",
-                    query={
-                        "query": {
-                            "bool": {
-                                "filter": request["filter"]
-                            }
-                        },
-                        "aggregations": {
-                            "image_url": {
-                                "terms": {
-                                    "field": "image_url",
-                                    "size": 1000,
-                                }
-                            }
+            image_urls = await DATA.response_values(
+                index="raw-images",
+                query={
+                    "query": {
+                        "bool": {
+                            "filter": request["filter"]
                         }
                     },
-                    value_keys=["aggregations", "image_url", "buckets", "*", "key"],
-                    size=0,
-                    debug=True,
-                )
-            ]
+                    "aggregations": {
+                        "image_url": {
+                            "terms": {
+                                "field": "image_url",
+                                "size": 1000,
+                            }
+                        }
+                    }
+                },
+                value_keys=["aggregations", "image_url", "buckets", "*", "key"],
+                size=0,
+                debug=True,
+            )
             log.info(image_urls)
-            await websocket.send_json(
+            await reply.send_json(
                 {"status": 200, "image_urls": image_urls}
             )
 
 
 
         else:
-            await websocket.send_json(
+            await reply.send_json(
                 {"status": 404, "message": f"no action found for {request['action']}"}
             )
 
@@ -482,8 +610,16 @@ if __name__ == "__main__":
     global S3_BUCKET
     global S3_CLIENT
     global DEBUG
+    global DATA
     ELASTICSEARCH_CLIENT, S3_CLIENT = get_clients(args)
     S3_BUCKET = args.s3_bucket
     DEBUG = args.debug
+    DATA = DataAccess(
+        elasticsearch_client=ELASTICSEARCH_CLIENT,
+        s3_client=S3_CLIENT,
+        bucket_name=S3_BUCKET,
+        local_data_store=Path("static/data"),
+        debug=DEBUG,
+    )
 
     uvicorn.run(app, host="0.0.0.0", port=8080, proxy_headers=True)
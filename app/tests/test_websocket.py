@@ -29,6 +29,12 @@ test_requests = [
     {
         "action": "list_experiments",
     },
+    {
+        "action": "similar",
+        "experiment": "concreteness",
+        "word": "utopia",
+        "k": 5,
+    },
     {
         "action": "list_image_urls",
         "filter": [{"term": {"image_id": "000dc9fa41fb56b826345029012ca249" }}]
@@ -39,3 +45,29 @@ test_requests = [
 async def test_websockets() -> None:
     for request in test_requests:
         await send_request(request)
+
+
+@pytest.mark.asyncio
+async def test_binary_get() -> None:
+    uri = "ws://localhost:8080/data"
+    async with websockets.connect(uri) as websocket:
+        await websocket.send(json.dumps({"action": "get", "experiment": None, "get": "utopia", "binary": True}))
+        while True:
+            message = json.loads(await websocket.recv())
+            if message.get("done", False):
+                break
+            image_bytes = await websocket.recv()
+            assert isinstance(image_bytes, bytes)
+            assert len(image_bytes) == message["image_bytes"]
+        assert message["sent"] == 1
+
+
+@pytest.mark.asyncio
+async def test_session() -> None:
+    uri = "ws://localhost:8080/data"
+    async with websockets.connect(uri) as websocket:
+        # several requests on one connection, answered by request_id in whatever order they finish
+        for request_id, request in enumerate(test_requests):
+            await websocket.send(json.dumps(dict(request, request_id=request_id)))
+        replies = [json.loads(await websocket.recv()) for _ in test_requests]
+        assert sorted(reply["request_id"] for reply in replies) == list(range(len(test_requests)))
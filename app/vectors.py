@@ -5,98 +5,102 @@ import json
 
 from imgserve.args import get_elasticsearch_args, get_s3_args
 from imgserve.clients import get_clients
-from imgserve.elasticsearch import get_response_value, fields_in_hits, all_field_values
 
 
-def get_experiment_metadata(
-    elasticsearch_client: Elasticsearch, experiment_name: str, debug: bool = False
-) -> Dict[str, Any]:
-    return {
-        "colorgrams": next(
-            get_response_value(
-                elasticsearch_client=elasticsearch_client,
-                index="colorgrams",
-                query={
-                    "query": {
-                        "bool": {"must": {"term": {"experiment_name": experiment_name}}}
-                    },
-                    "aggs": {"count": {"value_count": {"field": "query.keyword"}}},
-                },
-                value_keys=["aggregations", "count", "value"],
-                debug=debug,
-            )
-        ),
-        "raw-images": next(
-            get_response_value(
-                elasticsearch_client=elasticsearch_client,
-                index="raw-images",
-                query={
-                    "query": {
-                        "bool": {"must": {"term": {"experiment_name": experiment_name}}}
-                    },
-                    "aggs": {"count": {"value_count": {"field": "query"}}},
-                },
-                value_keys=["aggregations", "count", "value"],
-                debug=debug,
-            )
-        ),
-        "dimensions": fields_in_hits(
-            next(
-                get_response_value(
-                    elasticsearch_client=elasticsearch_client,
-                    index="raw-images",
-                    query={
-                        "query": {
-                            "bool": {"must": {"term": {"experiment_name": experiment_name}}}
+def mapped_fields(elasticsearch_client: Elasticsearch, index: str) -> List[str]:
+    """ top level fields in the mappings of every index matching index """
+    fields = set()
+    for mapping in elasticsearch_client.indices.get_mapping(index=index).values():
+        fields.update(mapping["mappings"].get("properties", dict()).keys())
+    return sorted(fields)
+
+
+def composite_buckets(
+    elasticsearch_client: Elasticsearch,
+    index: str,
+    composite: Dict[str, Any],
+    aggs: Optional[Dict[str, Any]] = None,
+    page_size: int = 1000,
+    debug: bool = False,
+) -> Generator[Dict[str, Any], None, None]:
+    """ every bucket of a composite aggregation, a page of page_size buckets at a time, so search.max_buckets is never reached """
+    query = {"aggs": {"buckets": {"composite": dict(composite, size=page_size)}}}
+    if aggs is not None:
+        query["aggs"]["buckets"]["aggs"] = aggs
+    while True:
+        if debug:
+            print(f"GET /{index}/_search?size=0\n{json.dumps(query, indent=2)}")
+        resp = elasticsearch_client.search(index=index, body=query, size=0)["aggregations"]["buckets"]
+        yield from resp["buckets"]
+        if len(resp["buckets"]) < page_size or "after_key" not in resp:
+            return
+        query["aggs"]["buckets"]["composite"].update(after=resp["after_key"])
+
+
+def get_experiments_metadata(
+    elasticsearch_client: Elasticsearch, debug: bool = False
+) -> Dict[str, Dict[str, Any]]:
+    """
+        Metadata of every experiment, from one composite aggregation by experiment_name on each of raw-images and colorgrams,
+        paged through so any number of experiments (and days) fits. dimensions are read from the raw-images mapping,
+        so every experiment lists the same dimensions.
+    """
+    colorgram_counts = {
+        bucket["key"]["experiment_name"]: bucket["count"]["value"]
+        for bucket in composite_buckets(
+            elasticsearch_client,
+            index="colorgrams",
+            composite={"sources": [{"experiment_name": {"terms": {"field": "experiment_name"}}}]},
+            aggs={"count": {"value_count": {"field": "query.keyword"}}},
+            debug=debug,
+        )
+    }
+    dimensions = mapped_fields(elasticsearch_client, index="raw-images")
+
+    experiments = dict()
+    # one bucket per experiment and day, images without a trial_timestamp still count towards their experiment
+    for bucket in composite_buckets(
+        elasticsearch_client,
+        index="raw-images",
+        composite={
+            "sources": [
+                {"experiment_name": {"terms": {"field": "experiment_name"}}},
+                {
+                    "date": {
+                        "date_histogram": {
+                            "field": "trial_timestamp",
+                            "calendar_interval": "day",
+                            "format": "yyyy-MM-dd",
+                            "missing_bucket": True,
                         }
-                    },
-                    value_keys=["hits", "hits"],
-                    size=10,
-                    debug=debug,
-                )
-            )
-        ),
-        "timestamps": set(
-            ts[:10]
-            for ts in get_response_value(
-                elasticsearch_client=elasticsearch_client,
-                index="raw-images",
-                query={
-                    "query": {
-                        "bool": {"must": {"term": {"experiment_name": experiment_name}}}
-                    },
-                    "aggs": {"dates": {"terms": {"field": "trial_timestamp"}}},
+                    }
                 },
-                value_keys=["aggregations", "dates", "buckets", "*", "key_as_string"],
-                debug=debug,
-            )
-        ),
-    }
+            ]
+        },
+        aggs={"count": {"value_count": {"field": "query"}}},
+        debug=debug,
+    ):
+        experiment_name = bucket["key"]["experiment_name"]
+        if experiment_name not in experiments:
+            experiments[experiment_name] = {
+                "colorgrams": colorgram_counts.get(experiment_name, 0),
+                "raw-images": 0,
+                "dimensions": list(dimensions),
+                "timestamps": set(),
+            }
+        experiments[experiment_name]["raw-images"] += bucket["count"]["value"]
+        if bucket["key"]["date"] is not None:
+            experiments[experiment_name]["timestamps"].add(bucket["key"]["date"])
+    return experiments
 
 
 def get_experiments(
     elasticsearch_client: Elasticsearch, debug: bool = False
 ) -> Dict[str, Any]:
     """
-        Get list of all experiments from colorgrams index, associate metadata with each one to include in informational tooltip
+        Get list of all experiments from raw-images index, associate metadata with each one to include in informational tooltip
     """
-    experiment_names = all_field_values(
-        elasticsearch_client,
-        field="experiment_name",
-        query={"query": {"match_all": {}}},
-    )
-    experiments = dict()
-    for experiment_name in experiment_names:
-        experiments.update(
-            {
-                experiment_name: get_experiment_metadata(
-                    elasticsearch_client=elasticsearch_client,
-                    experiment_name=experiment_name,
-                    debug=debug,
-                )
-            }
-        )
-    return experiments
+    return get_experiments_metadata(elasticsearch_client, debug=debug)
 
 
 if __name__ == "__main__":
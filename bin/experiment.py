@@ -6,12 +6,13 @@ import os
 import hashlib
 import json
 import socket
+import sys
 from pathlib import Path
 
 import requests
 from PIL import Image
 
-from imgserve import get_experiment_colorgrams_path, get_experiment_csv_path, STATIC
+from imgserve import get_experiment_colorgrams_path, get_experiment_csv_path, get_experiment_distributions_path, STATIC
 from imgserve.api import ImgServe, Experiment
 from imgserve.assemble import assemble_downloads
 from imgserve.args import (
@@ -22,15 +23,16 @@ from imgserve.args import (
     get_s3_args,
 )
 from imgserve.clients import get_clients, get_mturk_client
+from imgserve.distributions import DistributionStore, get_combined_vectors
 from imgserve.elasticsearch import (
     get_response_value,
     index_to_elasticsearch,
     COLORGRAMS_INDEX_PATTERN,
 )
 from imgserve.logger import simple_logger
-from imgserve.s3 import s3_put_image
+from imgserve.s3 import list_s3_keys, s3_put_image, S3Uploader
 from imgserve.trial import run_trial
-from imgserve.vectors import get_vectors
+from imgserve.vectors import export_distributions, get_vectors_concurrently, save_distributions
 from imgserve.utils import download_image
 
 
@@ -172,7 +174,7 @@ def main(args: argparse.Namespace) -> None:
                 log.info("does not sound good, exiting.")
                 return
 
-        run_trial(
+        failures = run_trial(
             elasticsearch_client=elasticsearch_client,
             experiment_name=args.experiment_name,
             local_data_store=args.local_data_store,
@@ -206,12 +208,29 @@ def main(args: argparse.Namespace) -> None:
             mturk_s3_bucket_name=args.s3_bucket,
             mturk_s3_region=args.mturk_aws_region,
             skip_vectors=args.skip_vectors,
+            distribution_sidecars=args.distribution_sidecars,
             query_timeout=300,
             no_compress=args.no_compress,
             cv2_cascade_min_neighbors=args.cv2_cascade_min_neighbors,
+            face_detection_scale=args.face_detection_scale,
+            link_strategy=args.link_strategy,
+            upload_workers=args.upload_workers,
+            face_detection_workers=args.face_detection_workers,
+            face_processes=args.face_processes,
+            vector_workers=args.vector_workers,
+            index_workers=args.index_workers,
+            parallel_queries=args.parallel_queries,
         )
 
-        log.info(f"image gathering completed")
+        log.info(
+            f"image gathering completed"
+            + (f", {len(failures)} searches failed" if len(failures) > 0 else "")
+        )
+        if len(failures) > 0:
+            # exit non-zero so batch/trial.sh runs the trial again, --skip-already-searched picks up only the failed searches
+            for search_term, failure in failures.items():
+                log.error(f"'{search_term}' failed at {failure}")
+            sys.exit(1)
         return
 
     if args.trial_ids is None:
@@ -235,6 +254,8 @@ def main(args: argparse.Namespace) -> None:
             dry_run=args.dry_run,
             force_remote_pull=args.force_remote_pull,
             prompt=args.prompt,
+            download_workers=args.download_workers,
+            link_strategy=args.link_strategy,
         )
 
         if args.dry_run:
@@ -249,12 +270,36 @@ def main(args: argparse.Namespace) -> None:
             app_static_path=STATIC,
             name=args.experiment_name,
         )
-        for vector, metadata in get_vectors(downloads):
+        # colorgrams are stored directly under the experiment name, faces and other assets are in nested prefixes
+        colorgram_keys = (
+            list_s3_keys(
+                s3_client, args.s3_bucket, prefix=f"{args.experiment_name}/", delimiter="/"
+            )
+            if not args.overwrite
+            else None
+        )
+        uploader = S3Uploader(
+            s3_client,
+            bucket=args.s3_bucket,
+            workers=args.upload_workers,
+            known_keys=colorgram_keys,
+        )
+        vector_errors = dict()
+        if args.cache_image_distributions:
+            vectors = get_combined_vectors(
+                downloads,
+                DistributionStore(args.local_data_store.joinpath("image-distributions")),
+                workers=args.vector_processes,
+                errors=vector_errors,
+            )
+        else:
+            vectors = get_vectors_concurrently(
+                downloads, workers=args.vector_processes, errors=vector_errors
+            )
+        for vector, metadata in vectors:
             # store colorgram images in S3
-            s3_put_image(
-                s3_client=s3_client,
+            uploader.submit(
                 image=vector.colorgram,
-                bucket=args.s3_bucket,
                 object_path=Path(args.experiment_name).joinpath(metadata["s3_key"]),
                 overwrite=args.overwrite,
             )
@@ -262,17 +307,30 @@ def main(args: argparse.Namespace) -> None:
             vector.colorgram.save(
                 colorgrams_path.joinpath(vector.word).with_suffix(".png")
             )
+            if args.distribution_sidecars:
+                save_distributions(
+                    vector,
+                    get_experiment_distributions_path(args.experiment_name, local_data_store=args.local_data_store),
+                    metadata["s3_key"],
+                )
             # queue colorgram metadata for indexing to Elasticsearch
             metadata.update(experiment_name=args.experiment_name)
             colorgram_documents.append(metadata)
 
+        uploader.close()
+        if len(vector_errors) > 0:
+            log.error(
+                f"could not create vectors from {len(vector_errors)} downloads folders or images: {', '.join(vector_errors.keys())}"
+            )
         log.info(f"{len(colorgram_documents)} colorgrams persisted to S3, indexing...")
 
         index_to_elasticsearch(
             elasticsearch_client=elasticsearch_client,
             index=COLORGRAMS_INDEX_PATTERN,
             docs=colorgram_documents,
-            identity_fields=["experiment_name", "downloads", "s3_key"],
+            # combined vectors only dedupe against, or overwrite, other combined vectors
+            identity_fields=["experiment_name", "downloads", "s3_key"]
+            + (["vector_aggregation"] if args.cache_image_distributions else list()),
             overwrite=args.overwrite,
         )
 
@@ -284,7 +342,7 @@ def main(args: argparse.Namespace) -> None:
         experiment.delete()
 
     if args.pull:
-        experiment.pull()
+        experiment.pull(workers=args.download_workers)
 
     if args.from_archive_path is not None:
         manifest_path = args.from_archive_path.joinpath("manifest.json")
@@ -292,6 +350,13 @@ def main(args: argparse.Namespace) -> None:
             raise FileNotFoundError(f"{manifest_path} not found, cannot index")
 
         manifests = json.loads(manifest_path.read_text())
+        archive_keys = (
+            list_s3_keys(
+                s3_client, args.s3_bucket, prefix=f"data/archive-{args.experiment_name}/"
+            )
+            if not args.overwrite
+            else None
+        )
 
         for manifest in manifests:
             manifest["experiment_name"] = args.experiment_name
@@ -320,6 +385,7 @@ def main(args: argparse.Namespace) -> None:
                 .joinpath(manifest["trial_id"])
                 .joinpath(rel_path),
                 overwrite=args.overwrite,
+                known_keys=archive_keys,
             )
             if not image_path.is_file():
                 raise FileNotFoundError(
@@ -363,7 +429,14 @@ def main(args: argparse.Namespace) -> None:
         for colorgram_document in experiment.colorgrams:
             del colorgram_document.source["downloads"]
             vectors.append(colorgram_document.source)
-        args.export_vectors_to.write_text(json.dumps(vectors, indent=2))
+        if args.export_vectors_to.suffix == ".npz":
+            export_distributions(
+                vectors,
+                args.export_vectors_to,
+                sidecars=get_experiment_distributions_path(args.experiment_name, local_data_store=args.local_data_store),
+            )
+        else:
+            args.export_vectors_to.write_text(json.dumps(vectors, indent=2))
 
     if args.get_unique_images:
         located_images = 0
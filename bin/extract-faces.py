@@ -1,20 +1,22 @@
 #!/usr/bin/env python3
 from pathlib import Path
 
-from imgserve.faces import facechop, NotAnImageError
+from imgserve.faces import facechop_many
 
 downloads_path = Path("/Volumes/LACIE/compsyn/data/unrest/original")
 
+
+def jobs():
+    for query_dir in downloads_path.iterdir():
+        query = query_dir.name
+        for image_path in query_dir.iterdir():
+            yield image_path, downloads_path.parent.joinpath("faces").joinpath(query)
+
+
 extracted_faces = 0
-for query_dir in downloads_path.iterdir():
-    query = query_dir.name
-    for image_path in query_dir.iterdir():
-        try:
-            for face_image in facechop(
-                image_path, downloads_path.parent.joinpath("faces").joinpath(query)
-            ):
-                extracted_faces += 1
-        except NotAnImageError as exc:
-            print(exc)
+for extraction in facechop_many(jobs()):
+    if extraction.error is not None:
+        print(extraction.error)
+    extracted_faces += len(extraction.faces)
 
 print(f"extracted {extracted_faces} faces")
@@ -21,7 +21,7 @@ from imgserve.args import (
     get_s3_args,
 )
 from imgserve.clients import get_clients, get_mturk_client
-from imgserve.elasticsearch import document_exists, index_to_elasticsearch, get_response_value, MTURK_HITS_INDEX_PATTERN, MTURK_ANSWERS_INDEX_PATTERN
+from imgserve.elasticsearch import index_to_elasticsearch, get_response_value, MTURK_HITS_INDEX_PATTERN, MTURK_ANSWERS_INDEX_PATTERN
 from imgserve.logger import simple_logger
 from imgserve.mturk import create_mturk_image_hit
 
@@ -421,16 +421,8 @@ def main(args: argparse.Namespace) -> None:
                     )
 
                     pbar.update(1)
-                    if document_exists(
-                        elasticsearch_client=elasticsearch_client,
-                        doc=mturk_hit_document,
-                        index="mturk-hits*",
-                        identity_fields=["internal_hit_id"]
-                    ):
-                        # more sophisticated approach -> involve Expiration date field for determining if hit is already "in the system" or not
-                        # skip faces that already have an associated mturk hit
-                        continue
-
+                    # faces that already have an associated mturk hit are skipped in bulk by index_to_elasticsearch, through identity_fields
+                    # more sophisticated approach -> involve Expiration date field for determining if hit is already "in the system" or not
 
                     mturk_hit_documents.append(mturk_hit_document)
 
@@ -35,6 +35,15 @@ def get_experiment_colorgrams_path(
     return experiment_path
 
 
+def get_experiment_distributions_path(
+    name: str, local_data_store: Path = LOCAL_DATA_STORE
+) -> Path:
+    """
+        get path of the distribution sidecars of an experiment's colorgrams, kept apart from the colorgrams the app serves
+    """
+    return local_data_store.joinpath("imgserve/colorgrams-distributions").joinpath(name)
+
+
 def get_experiment_csv_path(
     name: str, local_data_store: Path = LOCAL_DATA_STORE, app_static_path: Path = STATIC
 ) -> Path:
@@ -21,9 +21,12 @@ from .errors import (
     MissingCredentialsError,
     UnexpectedStatusCodeError,
     NoImagesInElasticsearchError,
+    S3Error,
 )
 from .logger import simple_logger
-from .s3 import get_s3_bytes
+from .pull import PullIndex, pull_s3_objects
+from .s3 import delete_s3_objects, get_s3_bytes, list_s3_objects
+from .similarity import SimilarityIndex
 
 
 class RawImageDocument(UserDict):
@@ -97,9 +100,6 @@ class Experiment:
             )
         return local_path
 
-    def _delete_s3_object(self, s3_path: Path) -> None:
-        self.s3_client.delete_object(Bucket=self.bucket_name, Key=str(s3_path))
-
     @property
     def raw_images(self) -> Generator[RawImageDocument]:
         yielded = 0
@@ -117,6 +117,22 @@ class Experiment:
             colorgram_document = ColorgramDocument(doc)
             yield colorgram_document
 
+    def similarity_index(self, field: str = "jzazbz_dist", rebuild: bool = False) -> SimilarityIndex:
+        """
+            Nearest-neighbour index over the colorgrams of this experiment, saved under the local data store.
+            The saved index is loaded unless rebuild is passed, it does not exist yet, or the experiment's colorgram count has changed since it was built.
+        """
+        index_path = self.local_data_store.joinpath(self.name).joinpath(f"similarity-{field}.npz")
+        if index_path.is_file() and not rebuild:
+            similarity_index = SimilarityIndex.load(index_path)
+            if similarity_index.colorgrams == self.total_colorgrams:
+                return similarity_index
+            self.log.info(f"colorgrams were added or removed since {index_path} was built, rebuilding it")
+        similarity_index = SimilarityIndex.from_colorgrams(self.colorgrams, field=field)
+        similarity_index.save(index_path)
+        self.log.info(f"indexed {len(similarity_index)} colorgrams by {field} in {index_path}")
+        return similarity_index
+
     @property
     def total_colorgrams(self) -> int:
         return self.elasticsearch_client.count(
@@ -162,32 +178,48 @@ class Experiment:
 
         self.log.info(f"{count} colorgram for {word}")
 
+    def _delete_from_s3(
+        self,
+        documents: Iterator[Union[RawImageDocument, ColorgramDocument]],
+        total: int,
+        kind: str,
+    ) -> Dict[str, str]:
+        """ the keys that could not be deleted, with their errors """
+        if self.dry_run:
+            self.log.info(f"would delete {total} {kind} from s3")
+            return dict()
+
+        def keys() -> Generator[str, None, None]:
+            for document in documents:
+                if document.path.is_file():
+                    document.path.unlink()
+                yield str(document.path)
+
+        errors = delete_s3_objects(
+            s3_client=self.s3_client,
+            bucket=self.bucket_name,
+            keys=keys(),
+            total=total,
+            desc=f"({kind}) Delete",
+        )
+        self.log.info(
+            f"deleted {total - len(errors)} {kind} from s3"
+            + (f" ({len(errors)} errors)" if len(errors) > 0 else "")
+        )
+        return errors
+
     def delete(self) -> None:
         self.log.info(f"deleting raw-images from S3...")
-        deleted = 0
-        for raw_image_document in self.raw_images:
-            if not self.dry_run:
-                try:
-                    self._delete_s3_object(raw_image_document.path)
-                except self.s3_client.exceptions.NoSuchKey:
-                    deleted -= 1
-            deleted += 1
-            if raw_image_document.path.is_file():
-                raw_image_document.path.unlink()
-        self.log.info(f"deleted {deleted} raw images from s3")
+        errors = self._delete_from_s3(self.raw_images, self.total_raw_images, "raw images")
 
         self.log.info(f"deleting colorgrams from S3...")
-        deleted = 0
-        for colorgram_document in self.colorgrams:
-            if not self.dry_run:
-                try:
-                    self._delete_s3_object(colorgram_document.path)
-                except self.s3_client.exceptions.NoSuchKey:
-                    deleted -= 1
-            deleted += 1
-            if colorgram_document.path.is_file():
-                colorgram_document.path.unlink()
-        self.log.info(f"deleted {deleted} colorgrams from s3")
+        errors.update(self._delete_from_s3(self.colorgrams, self.total_colorgrams, "colorgrams"))
+
+        if len(errors) > 0:
+            # the documents are the only record of which objects are left, keep them so delete can be run again
+            raise S3Error(
+                f"{len(errors)} objects could not be deleted from s3://{self.bucket_name}, not deleting documents from elasticsearch"
+            )
 
         self.log.info(f"deleting documents from elasticsearch...")
         delete_query = copy.deepcopy(self.query)
@@ -297,41 +329,76 @@ class Experiment:
             label_write_path.joinpath(label_filename).write_bytes(cg_path.read_bytes())
             self.log.info(f"labeled colorgram {label_filename}")
 
-    def pull(self, pull_raw_images: bool = False) -> None:
+    def pull(self, pull_raw_images: bool = False, workers: int = 8) -> None:
+        """
+            Mirror this experiment's colorgrams (and optionally raw images) to local_data_store.
+            Pulled objects are recorded in a local index, so a re-run only fetches missing or changed objects.
+        """
         self.log.info(
             "pulling colorgrams"
             + (" and raw-images" if pull_raw_images else "")
             + f" to {self.local_data_store}"
         )
+        experiment_path = self.local_data_store.joinpath(self.name)
         colorgrams_manifest = list()
-        with tqdm(total=self.total_colorgrams, desc="(colorgrams) Pull") as pbar:
+
+        def colorgram_objects() -> Generator[Tuple[str, Path], None, None]:
             for colorgram_document in self.colorgrams:
                 colorgrams_manifest.append(colorgram_document.source)
-                if not self.dry_run:
-                    self._sync_s3_path(
-                        colorgram_document.path,
-                        local_path=self.local_data_store.joinpath(self.name)
-                        .joinpath("colorgrams")
-                        .joinpath(colorgram_document.path.relative_to(self.name)),
+                yield (
+                    str(colorgram_document.path),
+                    experiment_path.joinpath("colorgrams").joinpath(
+                        colorgram_document.path.relative_to(self.name)
+                    ),
+                )
+
+        def raw_image_objects() -> Generator[Tuple[str, Path], None, None]:
+            for raw_image_document in self.raw_images:
+                yield (
+                    str(raw_image_document.path),
+                    experiment_path.joinpath("raw-images").joinpath(
+                        raw_image_document.path.relative_to("data")
+                    ),
+                )
+
+        if self.dry_run:
+            colorgrams_manifest.extend(
+                colorgram_document.source for colorgram_document in self.colorgrams
+            )
+        else:
+            with PullIndex(experiment_path.joinpath("pull-index.sqlite")) as pull_index:
+                pull_s3_objects(
+                    s3_client=self.s3_client,
+                    bucket=self.bucket_name,
+                    objects=colorgram_objects(),
+                    pull_index=pull_index,
+                    # colorgrams are few enough to list, which lets changed colorgrams be pulled again
+                    remote_objects=list_s3_objects(
+                        self.s3_client,
+                        self.bucket_name,
+                        prefix=f"{self.name}/",
+                        delimiter="/",
+                    ),
+                    workers=workers,
+                    total=self.total_colorgrams,
+                    desc="(colorgrams) Pull",
+                )
+                if pull_raw_images:
+                    pull_s3_objects(
+                        s3_client=self.s3_client,
+                        bucket=self.bucket_name,
+                        objects=raw_image_objects(),
+                        pull_index=pull_index,
+                        workers=workers,
+                        total=self.total_raw_images,
+                        desc="(raw images) Pull",
                     )
-                pbar.update(1)
 
         manifest_filename = f"colorgrams-{int(time.time())}.json"
-        self.local_data_store.joinpath(self.name).joinpath(
-            manifest_filename
-        ).write_text(json.dumps(colorgrams_manifest))
-
-        if pull_raw_images:
-            with tqdm(total=self.total_raw_images, desc="(raw images) Pull") as pbar:
-                for raw_image_document in self.raw_images:
-                    if not self.dry_run:
-                        self._sync_s3_path(
-                            raw_image_document.path,
-                            local_path=self.local_data_store.joinpath(self.name)
-                            .joinpath("raw-images")
-                            .joinpath(raw_image_document.path.relative_to("data")),
-                        )
-                    pbar.update(1)
+        experiment_path.mkdir(exist_ok=True, parents=True)
+        experiment_path.joinpath(manifest_filename).write_text(
+            json.dumps(colorgrams_manifest)
+        )
 
 
 class ImgServe:
@@ -4,6 +4,8 @@ import os
 import socket
 from pathlib import Path
 
+from .utils import LINK_STRATEGIES
+
 
 def get_elasticsearch_args(
     parser: Optional[argparse.ArgumentParser] = None,
@@ -235,7 +237,7 @@ def get_experiment_args(
     mode.add_argument(
         "--export-vectors-to",
         type=Path,
-        help="export colorgram documents as a JSON list",
+        help="export colorgram documents as a JSON list, or as stacked distribution arrays if the path ends in .npz",
     )
     mode.add_argument(
         "--get-unique-images",
@@ -304,6 +306,18 @@ def get_experiment_args(
         default=False,
         help="Pull images from S3 even if they are already on disk",
     )
+    experiment_parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=8,
+        help="number of images to download from S3 concurrently while assembling downloads or pulling",
+    )
+    experiment_parser.add_argument(
+        "--link-strategy",
+        choices=LINK_STRATEGIES,
+        default="hardlink",
+        help="how images are placed into assembled downloads folders, hardlink and reflink fall back to copy across filesystems",
+    )
     experiment_parser.add_argument(
         "--no-prompt",
         dest="prompt",
@@ -367,6 +381,58 @@ def get_imgserve_args(
         action="store_true",
         help="Do not compress images before mirroring them to S3. Default behaviour is to compress to 300x300 (stretch to fit)."
     )
+    imgserve_parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=8,
+        help="number of colorgram and face images to upload to S3 concurrently",
+    )
+    imgserve_parser.add_argument(
+        "--parallel-queries",
+        type=int,
+        default=1,
+        help="number of query runner containers to keep in flight during a trial",
+    )
+    imgserve_parser.add_argument(
+        "--face-detection-workers",
+        type=int,
+        default=1,
+        help="number of search terms to run face detection for concurrently during a trial",
+    )
+    imgserve_parser.add_argument(
+        "--face-processes",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes to detect and crop faces with, shared by all face detection workers",
+    )
+    imgserve_parser.add_argument(
+        "--vector-processes",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes to create vectors from downloads folders with, during experiment analysis",
+    )
+    imgserve_parser.add_argument(
+        "--distribution-sidecars",
+        action="store_true",
+        help="also save the distributions of each colorgram as <s3_key>.npz under imgserve/colorgrams-distributions/<experiment> in the local data store, which --export-vectors-to <path>.npz reads instead of the JSON distributions",
+    )
+    imgserve_parser.add_argument(
+        "--cache-image-distributions",
+        action="store_true",
+        help="create vectors by aggregating per-image colour distributions cached in the local data store, so regrouping an experiment by other dimensions does not read every image again",
+    )
+    imgserve_parser.add_argument(
+        "--vector-workers",
+        type=int,
+        default=1,
+        help="number of search terms to create vectors for concurrently during a trial",
+    )
+    imgserve_parser.add_argument(
+        "--index-workers",
+        type=int,
+        default=1,
+        help="number of search terms to index to Elasticsearch concurrently during a trial",
+    )
     imgserve_parser.add_argument(
         "--extract-faces",
         dest="skip_face_detection",
@@ -379,4 +445,9 @@ def get_imgserve_args(
         default=5,
         help="minNeighbors hyperparameter for cv2 haarcascade based face classification"
     )
+    imgserve_parser.add_argument(
+        "--face-detection-scale",
+        type=float,
+        help="factor to shrink images by before detecting faces in them, faster but may find different faces, faces are still cropped from the full size image (defaults to $IMGSERVE_FACE_DETECTION_SCALE or 1.0, no shrinking)"
+    )
     return parser
@@ -1,61 +1,134 @@
 from __future__ import annotations
+import copy
+import itertools
 import logging
 import os
 import json
 import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from tqdm import tqdm
 
+import botocore.exceptions
 from elasticsearch import Elasticsearch, helpers
 
-from .elasticsearch import RAW_IMAGES_INDEX_PATTERN, all_field_values
-from .errors import NoImagesInElasticsearchError, NoQueriesGatheredError
+from .api import RawImageDocument
+from .elasticsearch import RAW_IMAGES_INDEX_PATTERN
+from .errors import NoImagesInElasticsearchError
 from .logger import simple_logger
+from .s3 import get_s3_bytes
+from .utils import link_file
 
 """
   Assemble image data
 """
 
+# fields of a raw-images document required to locate its image, see RawImageDocument.path
+RAW_IMAGE_PATH_FIELDS = ["trial_id", "hostname", "query", "trial_timestamp", "image_id"]
 
-def recursively_combine(
-    field_values: Dict[str, List[str]], so_far: Optional[Dict[str, str]] = None
-) -> List[Dict]:
+
+def date_fields(
+    elasticsearch_client: Elasticsearch, fields: List[str], index: str = RAW_IMAGES_INDEX_PATTERN
+) -> Set[str]:
+    """ which of fields are mapped as dates in index """
+    mappings = elasticsearch_client.indices.get_field_mapping(fields=fields, index=index)
+    return {
+        field
+        for index_mapping in mappings.values()
+        for field, field_mapping in index_mapping["mappings"].items()
+        if any(leaf.get("type") in ["date", "date_nanos"] for leaf in field_mapping["mapping"].values())
+    }
+
+
+def plan_downloads(
+    elasticsearch_client: Elasticsearch,
+    query: Dict[str, Any],
+    dimensions: List[str],
+    page_size: int = 1000,
+) -> Dict[str, List[Path]]:
     """
-        create all possible queries to target each combination of field_values
+        Stream every raw image matching query once, and bucket image paths by the combination of dimension values each one has.
+        Dimension values are read from doc values, like the aggregations that used to enumerate them, so nested fields
+        and .keyword sub-fields work, and dates are epoch milliseconds. Only combinations that actually have images are returned, keyed by their slug.
     """
-    if so_far is None:
-        so_far = list()
-
-    # pivot around a new field every iteration
-    left_to_pivot = [field for field in field_values.keys() if field not in so_far]
-    pivot_field = left_to_pivot.pop()
-    if len(left_to_pivot) > 0:
-        # we still have more fields to get through, recurse for each pivot_value to generate all combinations
-        for pivot_value in field_values[pivot_field]:
-            pivot_so_far = {pivot_field: pivot_value}
-            pivot_so_far.update(so_far)
-            yield from recursively_combine(field_values, so_far=pivot_so_far)
-    else:
-        # we have accumulated so_far and now have just one list to get through for the final field, can yield actual queries here
-        shared_query_filter_parts = [
-            {"term": {field: value}} for field, value in so_far.items()
-        ]
-        for pivot_value in field_values[pivot_field]:
-            query = {
-                "query": {
-                    "bool": {
-                        "filter": shared_query_filter_parts
-                        + [{"term": {pivot_field: pivot_value}}]
-                    }
-                }
-            }
-            slug_parts = list()
-            for term_filter in query["query"]["bool"]["filter"]:
-                for field, value in term_filter["term"].items():
-                    slug_parts.append(f"{field}={value}")
-            slug = "|".join(slug_parts)
-            yield (slug, query)
+    log = simple_logger("imgserve.plan_downloads")
+
+    # slugs keep the field order folders have always been named with: every dimension after the first, then the first
+    slug_fields = dimensions[1:] + dimensions[:1]
+    dates = date_fields(elasticsearch_client, dimensions)
+    scan_query = copy.deepcopy(query)
+    scan_query.update(
+        _source=RAW_IMAGE_PATH_FIELDS,
+        docvalue_fields=[
+            {"field": field, "format": "epoch_millis"} if field in dates else field
+            for field in dimensions
+        ],
+    )
+
+    image_directories: Dict[str, List[Path]] = defaultdict(list)
+    missing_dimensions = 0
+    with tqdm(
+        total=elasticsearch_client.count(index=RAW_IMAGES_INDEX_PATTERN, body=query)["count"],
+        desc="(step 1/2) Query",
+    ) as pbar:
+        for image_doc in helpers.scan(
+            elasticsearch_client,
+            index=RAW_IMAGES_INDEX_PATTERN,
+            query=scan_query,
+            size=page_size,
+        ):
+            pbar.update(1)
+            # doc values are always a list, a document with a multi-valued dimension belongs to one combination for each value, as with a term filter
+            values = image_doc.get("fields", dict())
+            try:
+                relative_image_path = RawImageDocument(image_doc).path
+            except KeyError as e:
+                log.error(f"could not build image path for {image_doc}: {e}")
+                continue
+            if any(len(values.get(field, list())) == 0 for field in slug_fields):
+                missing_dimensions += 1
+                continue
+            for combination in itertools.product(*(values[field] for field in slug_fields)):
+                slug = "|".join(
+                    f"{field}={value}" for field, value in zip(slug_fields, combination)
+                )
+                image_directories[slug].append(relative_image_path)
+
+    if missing_dimensions > 0:
+        log.warning(
+            f"{missing_dimensions} images are missing one of {dimensions} and were left out"
+        )
+    log.debug(f"{len(image_directories)} combinations of {dimensions} have images")
+    return dict(image_directories)
+
+
+def assemble_image(
+    s3_client: botocore.clients.S3,
+    bucket_name: str,
+    image_path: Path,
+    image_assembly_paths: List[Path],
+    local_data_store: Path,
+    force_remote_pull: bool = False,
+    link_strategy: str = "hardlink",
+) -> None:
+    """
+        Place one raw image at each of image_assembly_paths, from the local archive if it is there, otherwise from S3.
+    """
+    # if we already have the .zip archive at this path, don't retrieve from s3
+    relative_path = image_path.relative_to("data")
+    archive_path = local_data_store.joinpath(relative_path.parts[0]).joinpath(
+        relative_path
+    )
+    if not archive_path.is_file() or force_remote_pull:
+        image_bytes = get_s3_bytes(
+            s3_client=s3_client, bucket_name=bucket_name, s3_path=image_path
+        )
+        archive_path.parent.mkdir(exist_ok=True, parents=True)
+        archive_path.write_bytes(image_bytes)
+    for image_assembly_path in image_assembly_paths:
+        link_file(archive_path, image_assembly_path, strategy=link_strategy)
 
 
 def assemble_downloads(
@@ -69,6 +142,8 @@ def assemble_downloads(
     dry_run: bool = False,
     force_remote_pull: bool = False,
     prompt: bool = True,
+    download_workers: int = 8,
+    link_strategy: str = "hardlink",
 ) -> Path:
     """
         Assemble a "downloads" folder for compsyn to run on.
@@ -87,65 +162,22 @@ def assemble_downloads(
 
     # query elasticsearch to assemble a list of required images
     if len(trial_ids) >= 0:
-        shared_filter = {"terms": {"trial_id": trial_ids}}
-        field_values_query = {"query": {"bool": {"filter": [shared_filter]}}}
+        field_values_query = {"query": {"bool": {"filter": [{"terms": {"trial_id": trial_ids}}]}}}
     else:
         log.info("no trial IDs passed, data will encompass all trial ids")
-        shared_filter = None
         field_values_query = {"query": {"match_all": {}}}
-    field_values = {
-        field: list(
-            all_field_values(elasticsearch_client, field, query=field_values_query)
-        )
-        for field in dimensions
-    }
-    errors = list()
-    for field_key, field_value in field_values.items():
-        if len(field_value) == 0:
-            errors.append(
-                f"Could not find any field values for {RAW_IMAGES_INDEX_PATTERN} matching the query: {json.dumps(field_values_query)}"
-            )
-    if len(errors) > 0:
-        raise NoImagesInElasticsearchError("\n".join(errors))
-    queries = [(slug, query) for (slug, query) in recursively_combine(field_values)]
-    if len(queries) == 0:
-        log.debug(f"{len(queries)} queries gathered for data extraction")
-        raise NoQueriesGatheredError(
-            f"no queries could be generated for field values {field_values}!"
+    image_directories = plan_downloads(
+        ELASTICSEARCH_CLIENT, query=field_values_query, dimensions=dimensions
+    )
+    if len(image_directories) == 0:
+        raise NoImagesInElasticsearchError(
+            f"Could not find any images in {RAW_IMAGES_INDEX_PATTERN} with values for {dimensions} matching the query: {json.dumps(field_values_query)}"
         )
 
-    image_directories: Dict[str, List[Path]] = dict()
-    with tqdm(total=len(queries), desc="(step 1/2) Query") as pbar:
-        for slug, query in queries:
-            if shared_filter is not None:
-                query["query"]["bool"]["filter"].append(shared_filter)
-            paths = list()
-            for image_doc in helpers.scan(
-                ELASTICSEARCH_CLIENT, index=RAW_IMAGES_INDEX_PATTERN, query=query
-            ):
-                source = image_doc["_source"]
-                try:
-                    relative_image_path = (
-                        Path("data")
-                        .joinpath(source["trial_id"])
-                        .joinpath(source["hostname"])
-                        .joinpath(source["query"].replace(" ", "_"))
-                        .joinpath(source["trial_timestamp"])
-                        .joinpath("images")
-                        .joinpath(source["image_id"])
-                        .with_suffix(".jpg")
-                    )
-                    paths.append(relative_image_path)
-                except KeyError as e:
-                    print(image_doc)
-                    print(e)
-            image_directories[slug] = paths
-            pbar.update(1)
-
     total_images = sum([len(image_paths) for image_paths in image_directories.values()])
     if total_images == 0:
         raise NoImagesInElasticsearchError(
-            f"{json.dumps(queries, indent=2)}\n  0 images available for assembly from 'raw-images' according to the above query. Has this trial been indexed?"
+            f"{json.dumps(field_values_query, indent=2)}\n  0 images available for assembly from 'raw-images' according to the above query. Has this trial been indexed?"
         )
 
     if not dry_run:
@@ -165,33 +197,49 @@ def assemble_downloads(
                     )
                     shutil.rmtree(downloads_path)
         downloads_path.mkdir(exist_ok=True, parents=True)
-        with tqdm(total=total_images, desc="(step 2/2) Download") as pbar:
-            for slug, image_paths in image_directories.items():
-                images_directory = downloads_path.joinpath(slug)
-                for image_path in image_paths:
-                    # if we already have the .zip archive at this path, don't retrieve from s3
-                    relative_path = image_path.relative_to("data")
-                    archive_path = local_data_store.joinpath(
-                        relative_path.parts[0]
-                    ).joinpath(relative_path)
-                    image_assembly_path = images_directory.joinpath(image_path.name)
-                    image_assembly_path.parent.mkdir(exist_ok=True, parents=True)
-                    if archive_path.is_file() and not force_remote_pull:
-                        image_assembly_path.write_bytes(archive_path.read_bytes())
-                    else:
-                        image_obj = s3_client.get_object(
-                            Bucket=bucket_name, Key=str(image_path)
-                        )
-                        archive_path.parent.mkdir(exist_ok=True, parents=True)
-                        try:
-                            archive_path.write_bytes(image_obj["Body"].read())
-                        except botocore.exceptions.ReadTimeoutError as exc:
-                            # TODO retry logic
-                            log.error(f"S3 read timeout, skipping. {exc}")
-                        images_directory.joinpath(image_path.name).write_bytes(
-                            archive_path.read_bytes()
-                        )
+        # each image is fetched once, even if it belongs to more than one combination
+        assembly_paths: Dict[Path, List[Path]] = defaultdict(list)
+        for slug, image_paths in image_directories.items():
+            images_directory = downloads_path.joinpath(slug)
+            images_directory.mkdir(exist_ok=True, parents=True)
+            for image_path in image_paths:
+                assembly_paths[image_path].append(images_directory.joinpath(image_path.name))
+
+        failures: Dict[str, str] = dict()
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            futures = {
+                executor.submit(
+                    assemble_image,
+                    s3_client=s3_client,
+                    bucket_name=bucket_name,
+                    image_path=image_path,
+                    image_assembly_paths=image_assembly_paths,
+                    local_data_store=local_data_store,
+                    force_remote_pull=force_remote_pull,
+                    link_strategy=link_strategy,
+                ): image_path
+                for image_path, image_assembly_paths in assembly_paths.items()
+            }
+            with tqdm(total=len(futures), desc="(step 2/2) Download") as pbar:
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except (
+                        botocore.exceptions.BotoCoreError,
+                        botocore.exceptions.ClientError,
+                        OSError,
+                    ) as exc:
+                        failures[str(futures[future])] = repr(exc)
                     pbar.update(1)
+
+        if len(failures) > 0:
+            failures_report = local_data_store.joinpath(experiment_name).joinpath(
+                f"download-failures-{int(time.time())}.json"
+            )
+            failures_report.write_text(json.dumps(failures, indent=2))
+            log.error(
+                f"{len(failures)} of {len(assembly_paths)} images could not be assembled, see {failures_report}"
+            )
     log.info(f"{total_images} image paths gathered")
     if not dry_run:
         log.info(f"assembled directory: {downloads_path}")
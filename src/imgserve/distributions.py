@@ -0,0 +1,283 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from compsyn.vectors import Vector
+from PIL import Image
+
+from .logger import simple_logger
+from .utils import link_file
+from .vectors import tags_to_hash, vector_metadata
+
+"""
+  Per-image colour distributions cached on disk, so the colorgram of any grouping of images is an aggregation of cached rows
+"""
+
+# marks colorgram documents aggregated from cached per-image distributions, it is part of their s3_key and an identity field
+VECTOR_AGGREGATION = "image_mean"
+
+log = simple_logger("imgserve.distributions")
+
+
+def image_sha256(image_path: Path) -> str:
+    return hashlib.sha256(image_path.read_bytes()).hexdigest()
+
+
+def image_distributions(image_path: Path) -> Dict[str, numpy.ndarray]:
+    """
+        Distributions of a single image, computed by compsyn from a folder holding only that image,
+        along with the pixels of that image's colorgram.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        folder = Path(workdir).joinpath("image")
+        folder.mkdir()
+        link_file(image_path, folder.joinpath(image_path.name), strategy="symlink")
+        vector = Vector(folder.name).load_from_folder(folder.parent)
+        return {
+            "rgb_dist": np.asarray(vector.rgb_dist, dtype=np.float64),
+            "jzazbz_dist": np.asarray(vector.jzazbz_dist, dtype=np.float64),
+            "colorgram": np.asarray(vector.colorgram, dtype=np.uint8),
+        }
+
+
+class DistributionStore:
+    """
+        Append-only store of per-image arrays, keyed by the sha256 of the image bytes.
+        Each field is one raw file of fixed size rows, memory-mapped for reads so large experiments stay out of RAM,
+        and a SQLite index maps each image to its row. Only one process should add to a store at a time.
+    """
+
+    def __init__(self, path: Path) -> None:
+        path.mkdir(exist_ok=True, parents=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._maps: Dict[str, numpy.memmap] = dict()
+        self._connection = sqlite3.connect(
+            str(path.joinpath("index.sqlite")), check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS images (image_sha256 TEXT PRIMARY KEY, row INTEGER)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS fields (name TEXT PRIMARY KEY, dtype TEXT, shape TEXT)"
+        )
+        self._connection.commit()
+        self._fields = {
+            name: (np.dtype(dtype), tuple(json.loads(shape)))
+            for name, dtype, shape in self._connection.execute("SELECT * FROM fields")
+        }
+        self._rows = self._connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        # rows written by an add that was interrupted before it reached the index are dropped
+        for name in self._fields:
+            field_path = self._field_path(name)
+            if field_path.is_file() and field_path.stat().st_size > self._rows * self._row_bytes(name):
+                with open(field_path, "r+b") as f:
+                    f.truncate(self._rows * self._row_bytes(name))
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def _field_path(self, name: str) -> Path:
+        return self.path.joinpath(name).with_suffix(".bin")
+
+    def _row_bytes(self, name: str) -> int:
+        dtype, shape = self._fields[name]
+        return dtype.itemsize * int(np.prod(shape))
+
+    def rows(self, image_sha256s: Iterable[str]) -> Dict[str, int]:
+        """ row of each of image_sha256s that is in the store """
+        image_sha256s = list(image_sha256s)
+        rows = dict()
+        with self._lock:
+            for start in range(0, len(image_sha256s), 500):
+                chunk = image_sha256s[start : start + 500]
+                rows.update(
+                    self._connection.execute(
+                        f"SELECT image_sha256, row FROM images WHERE image_sha256 IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                )
+        return rows
+
+    def add(self, image_sha256: str, arrays: Dict[str, numpy.ndarray]) -> int:
+        with self._lock:
+            existing = self._connection.execute(
+                "SELECT row FROM images WHERE image_sha256 = ?", (image_sha256,)
+            ).fetchone()
+            if existing is not None:
+                return existing[0]
+            if len(self._fields) > 0 and set(arrays) != set(self._fields):
+                raise ValueError(f"expected arrays for {sorted(self._fields)}, got {sorted(arrays)}")
+            for name, array in arrays.items():
+                if name not in self._fields:
+                    self._fields[name] = (array.dtype, array.shape)
+                    self._connection.execute(
+                        "INSERT INTO fields VALUES (?, ?, ?)",
+                        (name, array.dtype.str, json.dumps(list(array.shape))),
+                    )
+                elif self._fields[name][1] != array.shape:
+                    raise ValueError(
+                        f"{name} of {image_sha256} has shape {array.shape}, the store holds {self._fields[name][1]}"
+                    )
+            row = self._rows
+            for name, array in arrays.items():
+                with open(self._field_path(name), "ab") as f:
+                    f.write(np.ascontiguousarray(array, dtype=self._fields[name][0]).tobytes())
+            self._connection.execute("INSERT INTO images VALUES (?, ?)", (image_sha256, row))
+            self._connection.commit()
+            self._rows += 1
+            return row
+
+    def field(self, name: str) -> numpy.ndarray:
+        """ every row of one field, memory-mapped """
+        with self._lock:
+            dtype, shape = self._fields[name]
+            if self._rows == 0:
+                return np.empty((0,) + shape, dtype=dtype)
+            field_map = self._maps.get(name)
+            if field_map is None or field_map.shape[0] != self._rows:
+                field_map = np.memmap(
+                    self._field_path(name), dtype=dtype, mode="r", shape=(self._rows,) + shape
+                )
+                self._maps[name] = field_map
+            return field_map
+
+    def close(self) -> None:
+        with self._lock:
+            self._maps.clear()
+            self._connection.close()
+
+
+def cache_image_distributions(
+    store: DistributionStore,
+    image_paths: Iterable[Path],
+    workers: Optional[int] = None,
+    errors: Optional[Dict[str, str]] = None,
+) -> Dict[Path, str]:
+    """
+        Add the distributions of each image in image_paths that the store does not have yet, computed in a pool of worker processes.
+        Returns the sha256 of every image that has distributions in the store, images that fail are recorded in errors by path.
+    """
+    workers = workers if workers is not None else os.cpu_count()
+    errors = errors if errors is not None else dict()
+    image_sha256s = {image_path: image_sha256(image_path) for image_path in image_paths}
+    known = store.rows(image_sha256s.values())
+    missing: Dict[str, Path] = dict()
+    for image_path, sha256 in image_sha256s.items():
+        if sha256 not in known:
+            missing.setdefault(sha256, image_path)
+    log.info(
+        f"{len(image_sha256s) - len(missing)} images already have cached distributions, computing {len(missing)}"
+    )
+
+    failed = set()
+    if len(missing) > 0:
+        in_flight = dict()
+
+        def collect(futures: Set[Future]) -> None:
+            for future in futures:
+                sha256 = in_flight.pop(future)
+                try:
+                    store.add(sha256, future.result())
+                except Exception as exc:
+                    log.error(f"could not compute distributions of {missing[sha256]}: {exc!r}")
+                    errors[str(missing[sha256])] = repr(exc)
+                    failed.add(sha256)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for sha256, image_path in missing.items():
+                if len(in_flight) >= workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[executor.submit(image_distributions, image_path)] = sha256
+            collect(wait(in_flight).done)
+
+    return {
+        image_path: sha256
+        for image_path, sha256 in image_sha256s.items()
+        if sha256 not in failed
+    }
+
+
+@dataclass
+class CombinedVector:
+    """ stands in for a compsyn Vector, with the distributions and colorgram of a group of images aggregated from a DistributionStore """
+
+    word: str
+    rgb_dist: numpy.ndarray
+    jzazbz_dist: numpy.ndarray
+    rgb_dist_std: numpy.ndarray
+    jzazbz_dist_std: numpy.ndarray
+    colorgram: Image.Image
+
+
+def combine(store: DistributionStore, image_sha256s: Iterable[str], word: str) -> CombinedVector:
+    """
+        Aggregate the cached rows of a group of images the way compsyn aggregates a folder:
+        distributions are the mean of the per-image distributions (with their standard deviation), the colorgram is the mean image, truncated to uint8.
+        An image that is in the group more than once, e.g. returned by several searches, is counted each time, as compsyn counts each file.
+    """
+    image_sha256s = list(image_sha256s)
+    known = store.rows(image_sha256s)
+    rows = np.array([known[image_sha256] for image_sha256 in image_sha256s if image_sha256 in known], dtype=np.int64)
+    if len(rows) == 0:
+        raise ValueError(f"no cached distributions for any image of {word}")
+    rgb_dists = store.field("rgb_dist")[rows]
+    jzazbz_dists = store.field("jzazbz_dist")[rows]
+    return CombinedVector(
+        word=word,
+        rgb_dist=rgb_dists.mean(axis=0),
+        jzazbz_dist=jzazbz_dists.mean(axis=0),
+        rgb_dist_std=rgb_dists.std(axis=0),
+        jzazbz_dist_std=jzazbz_dists.std(axis=0),
+        colorgram=Image.fromarray(
+            store.field("colorgram")[rows].mean(axis=0).astype(np.uint8)
+        ),
+    )
+
+
+def get_combined_vectors(
+    downloads_path: Path,
+    store: DistributionStore,
+    workers: Optional[int] = None,
+    errors: Optional[Dict[str, str]] = None,
+) -> Generator[Tuple[CombinedVector, Dict[str, Any]], None, None]:
+    """
+        Like get_vectors, but each folder's vector is aggregated from per-image distributions cached in store.
+        Only images the store has not seen are read from their pixels, so regrouping an experiment by other dimensions is cheap.
+        Folders whose images all fail are recorded in errors by folder name. The documents are marked with
+        vector_aggregation=image_mean, which is also hashed into their s3_key, so they never replace or dedupe against
+        colorgrams compsyn made from the whole folder. Index them with vector_aggregation among the identity fields.
+    """
+    errors = errors if errors is not None else dict()
+    folders = [folder for folder in downloads_path.iterdir() if folder.is_dir()]
+    folder_images = {folder: list(folder.iterdir()) for folder in folders}
+    image_sha256s = cache_image_distributions(
+        store,
+        (image_path for images in folder_images.values() for image_path in images),
+        workers=workers,
+        errors=errors,
+    )
+
+    for folder, images in folder_images.items():
+        cached = [image_sha256s[image_path] for image_path in images if image_path in image_sha256s]
+        if len(cached) == 0:
+            errors[folder.name] = f"no cached distributions for any of {len(images)} images"
+            continue
+        vector = combine(store, cached, word=folder.name)
+        metadata = vector_metadata(folder, vector)
+        if metadata is None:
+            continue
+        metadata.update(
+            vector_aggregation=VECTOR_AGGREGATION,
+            s3_key=tags_to_hash(folder.name.split("|") + [f"vector_aggregation={VECTOR_AGGREGATION}"]),
+        )
+        yield vector, metadata
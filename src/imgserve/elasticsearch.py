@@ -1,6 +1,11 @@
 from __future__ import annotations
 import copy
+import dataclasses
+import itertools
 import json
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from pathlib import Path
 
 import elasticsearch
@@ -8,6 +13,7 @@ from elasticsearch_dsl import Search
 from retry import retry
 
 from .errors import (
+    BulkIndexingError,
     ElasticsearchUnreachableError,
     ElasticsearchNotReadyError,
     MissingTemplateError,
@@ -102,14 +108,103 @@ def document_exists(
         return False
 
 
-def doc_gen(
+def _identity_values(value: Any) -> Set[Any]:
+    # a term filter against a multi-valued field matches if any of the values match, mirror that when comparing locally
+    return set(value) if isinstance(value, list) else {value}
+
+
+def _identity_matches(
+    doc: Dict[str, Any], source: Dict[str, Any], identity_fields: List[str]
+) -> bool:
+    for field in identity_fields:
+        if field not in source:
+            return False
+        if _identity_values(doc[field]).isdisjoint(_identity_values(source[field])):
+            return False
+    return True
+
+
+# well under index.max_terms_count (65536 by default), the most values a terms filter may hold
+MAX_TERMS_PER_QUERY = 10000
+
+
+def _identity_batches(
+    docs: List[Dict[str, Any]], identity_fields: List[str], max_terms: int
+) -> Generator[Dict[str, Set[Any]], None, None]:
+    """ split docs so the union of values of each identity field stays within max_terms, multi-valued fields add up quickly """
+    batch_values = {field: set() for field in identity_fields}
+    for doc in docs:
+        doc_values = {field: _identity_values(doc[field]) for field in identity_fields}
+        if any(
+            len(batch_values[field]) > 0
+            and len(batch_values[field] | doc_values[field]) > max_terms
+            for field in identity_fields
+        ):
+            yield batch_values
+            batch_values = {field: set() for field in identity_fields}
+        for field, values in doc_values.items():
+            batch_values[field].update(values)
+    if any(len(values) > 0 for values in batch_values.values()):
+        yield batch_values
+
+
+@retry(tries=3, backoff=5, delay=2)
+def _scan_identity_values(
+    elasticsearch_client: Elasticsearch,
+    index: str,
+    identity_values: Dict[str, Set[Any]],
+) -> List[Dict[str, Any]]:
+    body = {
+        "query": {
+            "bool": {
+                "filter": [
+                    {"terms": {field: sorted(values, key=str)}}
+                    for field, values in identity_values.items()
+                ]
+            }
+        },
+        "_source": list(identity_values),
+    }
+    try:
+        return list(
+            elasticsearch.helpers.scan(elasticsearch_client, index=index, query=body)
+        )
+    except elasticsearch.exceptions.NotFoundError:
+        return list()
+
+
+def existing_documents(
     elasticsearch_client: Elasticsearch,
     docs: List[Dict[str, Any]],
     index: str,
+    identity_fields: List[str],
+    max_terms: int = MAX_TERMS_PER_QUERY,
+) -> List[Dict[str, Any]]:
+    """
+        Retrieve every document in index that could match the identity of one of docs, with as few scans as max_terms allows.
+        Each identity field is filtered with the union of values across docs, so the hits are a superset that must be matched locally.
+    """
+    hits = dict()
+    for identity_values in _identity_batches(docs, identity_fields, max_terms):
+        for hit in _scan_identity_values(elasticsearch_client, index, identity_values):
+            # the same document can match docs of more than one batch
+            hits[(hit["_index"], hit["_id"])] = hit
+    return list(hits.values())
+
+
+def doc_gen(
+    elasticsearch_client: Elasticsearch,
+    docs: Iterable[Dict[str, Any]],
+    index: str,
     identity_fields: Optional[List[str]],
     overwrite: bool,
-    quiet: bool = False
+    quiet: bool = False,
+    identity_batch_size: int = 1000,
 ) -> Generator[Dict[str, Any], None, None]:
+    """
+        Yield bulk actions for docs, skipping (or with overwrite, replacing) documents that already exist in index.
+        Existence is checked for identity_batch_size documents at a time, rather than with one search per document.
+    """
 
     if identity_fields is not None:
         # must have manage permission on index to refresh, this is only necessary for idempotent indexing calls
@@ -117,20 +212,66 @@ def doc_gen(
 
     yielded = 0
     exists = 0
-    for doc in docs:
-        doc = dict(doc) # convert Index classes to plain dictionaries for Elasticsearch API
-        if identity_fields is not None and document_exists(
-            elasticsearch_client, doc, index, identity_fields, overwrite
-        ):
-            exists += 1
-            continue
-        doc.update(_index=index)
-        yield doc
-        yielded += 1
+    deleted = set()
+    docs = iter(docs)
+    while True:
+        # convert Index classes to plain dictionaries for Elasticsearch API
+        docs_batch = [dict(doc) for doc in itertools.islice(docs, identity_batch_size)]
+        if len(docs_batch) == 0:
+            break
+
+        # if a doc is missing an identity field, we will index the new document
+        identifiable = (
+            [
+                doc
+                for doc in docs_batch
+                if all(field in doc for field in identity_fields)
+            ]
+            if identity_fields is not None
+            else list()
+        )
+        # bucket existing documents by their first identity field, so each doc is only compared against plausible matches
+        existing = defaultdict(list)
+        if len(identifiable) > 0:
+            for hit in existing_documents(
+                elasticsearch_client, identifiable, index, identity_fields
+            ):
+                for value in _identity_values(
+                    hit["_source"].get(identity_fields[0], list())
+                ):
+                    existing[value].append(hit)
+
+        for doc in docs_batch:
+            matches = dict()
+            if len(existing) > 0 and all(field in doc for field in identity_fields):
+                for value in _identity_values(doc[identity_fields[0]]):
+                    for hit in existing.get(value, list()):
+                        if _identity_matches(doc, hit["_source"], identity_fields):
+                            matches[hit["_id"]] = hit
+            if len(matches) > 0:
+                if not overwrite:
+                    exists += 1
+                    continue
+                if len(matches) > 1:
+                    log.warning(
+                        f"{len(matches)} {index} documents matched the identity of {[doc[field] for field in identity_fields]}"
+                    )
+                for hit in matches.values():
+                    if hit["_id"] in deleted:
+                        continue
+                    log.info(
+                        f"deleting existing {index} document matching identity (id: {hit['_id']})"
+                    )
+                    deleted.add(hit["_id"])
+                    yield {"_op_type": "delete", "_index": hit["_index"], "_id": hit["_id"]}
+            doc.update(_index=index)
+            yield doc
+            yielded += 1
     if not quiet:
         log.info(
             f"{yielded} documents yielded for indexing to {index}"
             + (f" ({exists} already existed)" if exists > 0 else "")
+            + (f" ({len(deleted)} existing documents replaced)" if len(deleted) > 0 else "")
         )
 
 
@@ -144,23 +285,96 @@ def fields_in_hits(hits: Iterator[Dict[str, Any]]) -> List[str]:
     return list(fields)
 
 
-def batch(iterable: Iterable, n: int = 1) -> Generator[Iterable, None, None]:
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
+def chunk_actions(
+    actions: Iterable[Dict[str, Any]], chunk_size: int
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+        Chunk a stream of bulk actions by document count, without materializing the stream.
+    """
+    actions = iter(actions)
+    while True:
+        chunk = list(itertools.islice(actions, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+@dataclass
+class BulkChunkResult:
+    chunk: int
+    actions: int
+    succeeded: int = 0
+    errors: List[Any] = dataclasses.field(default_factory=list)
+
+    @property
+    def failed(self) -> bool:
+        return len(self.errors) > 0
+
+
+@dataclass
+class BulkIndexReport:
+    index: str
+    chunks: List[BulkChunkResult] = dataclasses.field(default_factory=list)
+
+    @property
+    def succeeded(self) -> int:
+        return sum(chunk.succeeded for chunk in self.chunks)
+
+    @property
+    def failed_chunks(self) -> List[BulkChunkResult]:
+        return [chunk for chunk in self.chunks if chunk.failed]
+
+
+@retry(
+    exceptions=elasticsearch.exceptions.ConnectionError, tries=3, backoff=5, delay=2
+)
+def _bulk_chunk(
+    elasticsearch_client: Elasticsearch, chunk: List[Dict[str, Any]], max_chunk_bytes: int
+) -> Tuple[int, List[Any]]:
+    # connection failures raise, so only this chunk is retried, document level failures are reported back rather than raised.
+    # the helper serializes each action once, and splits the chunk into more than one request if it is over max_chunk_bytes
+    return elasticsearch.helpers.bulk(
+        elasticsearch_client,
+        chunk,
+        chunk_size=len(chunk),
+        max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=False,
+        raise_on_exception=True,
+    )
+
+
+def _index_chunk(
+    elasticsearch_client: Elasticsearch, chunk_number: int, chunk: List[Dict[str, Any]], max_chunk_bytes: int
+) -> BulkChunkResult:
+    result = BulkChunkResult(chunk=chunk_number, actions=len(chunk))
+    try:
+        result.succeeded, errors = _bulk_chunk(elasticsearch_client, chunk, max_chunk_bytes)
+        result.errors.extend(errors)
+    except elasticsearch.exceptions.ElasticsearchException as exc:
+        # retries ran out, the whole chunk failed
+        result.errors.append(repr(exc))
+    return result
 
 
-@retry(tries=3, backoff=5, delay=2)
 def index_to_elasticsearch(
     elasticsearch_client: Elasticsearch,
     index: str,
-    docs: Iterator[Dict[str, Any]],
+    docs: Iterable[Dict[str, Any]],
     identity_fields: Optional[List[str]] = None,
     overwrite: bool = False,
     apply_template: bool = False,
     batch_size: Optional[int] = None,
-    quiet: bool = False
-) -> None:
+    quiet: bool = False,
+    identity_batch_size: int = 1000,
+    workers: int = 4,
+    max_chunk_bytes: int = 100 * 1024 * 1024,
+) -> BulkIndexReport:
+    """
+        Stream docs to Elasticsearch in chunks of at most batch_size documents, each sent in requests of at most max_chunk_bytes,
+        with up to workers chunks in flight concurrently. Each chunk is retried on its own, so a failure
+        never re-sends chunks that were already indexed. Raises BulkIndexingError once every chunk has been sent
+        if any of them still had errors.
+    """
 
     if apply_template:
         try:
@@ -172,19 +386,39 @@ def index_to_elasticsearch(
                 f"no index template for {index}, please add one to db/{index}.template.json and update '_overridable_template_paths' in src/imgserve/elasticsearch.py"
             ) from e
 
-    if batch_size is None:
-        elasticsearch.helpers.bulk(
-            elasticsearch_client,
-            doc_gen(elasticsearch_client, docs, index, identity_fields, overwrite, quiet),
-        )
-    else:
-        for docs_batch in batch(docs, n=batch_size):
-            elasticsearch.helpers.bulk(
-                elasticsearch_client,
-                doc_gen(elasticsearch_client, docs_batch, index, identity_fields, overwrite, quiet),
+    chunks = chunk_actions(
+        doc_gen(elasticsearch_client, docs, index, identity_fields, overwrite, quiet, identity_batch_size),
+        chunk_size=batch_size if batch_size is not None else 500,
+    )
+
+    report = BulkIndexReport(index=index)
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk_number, chunk in enumerate(chunks):
+            # bound the chunks held in memory while the action stream is consumed
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                report.chunks.extend(future.result() for future in done)
+            in_flight.add(
+                executor.submit(_index_chunk, elasticsearch_client, chunk_number, chunk, max_chunk_bytes)
             )
+        report.chunks.extend(future.result() for future in wait(in_flight).done)
+
+    report.chunks.sort(key=lambda result: result.chunk)
+    for result in report.failed_chunks:
+        log.error(
+            f"{len(result.errors)} errors in chunk {result.chunk} of {index} ({result.succeeded}/{result.actions} succeeded): {result.errors[:3]}"
+        )
     if not quiet:
-        log.info("bulk indexing complete")
+        log.info(
+            f"bulk indexing complete: {report.succeeded} actions in {len(report.chunks)} chunks"
+            + (f", {len(report.failed_chunks)} chunks with errors" if len(report.failed_chunks) > 0 else "")
+        )
+    if len(report.failed_chunks) > 0:
+        raise BulkIndexingError(
+            f"{sum(len(result.errors) for result in report.failed_chunks)} errors in {len(report.failed_chunks)} of {len(report.chunks)} chunks indexed to {index}"
+        )
+    return report
 
 
 @retry(tries=3, backoff=5, delay=2)
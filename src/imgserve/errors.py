@@ -54,6 +54,10 @@ class MissingTemplateError(ElasticsearchError):
     pass
 
 
+class BulkIndexingError(ElasticsearchError):
+    pass
+
+
 class NoQueriesGatheredError(Exception):
     pass
 
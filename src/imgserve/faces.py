@@ -1,9 +1,17 @@
 from __future__ import annotations
 
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 import cv2
+import numpy as np
 
 from .logger import simple_logger
 
@@ -13,11 +21,32 @@ assert Path(FACE_CLASSIFIER_XML).is_file(), f"{FACE_CLASSIFIER_XML} is not a fil
 
 FACE_CLASSIFIER = cv2.CascadeClassifier(FACE_CLASSIFIER_XML)
 
+# faces are detected on a grayscale copy of each image shrunk by this factor, then cropped from the full size image.
+# at 1.0 detection finds exactly the boxes the original full size detection did (see test_default_scale_matches_full_size_detection).
+# measured on tests/faces with haarcascade_frontalface_alt, 0.5 runs ~3.5x faster (34s -> 9.5s) but finds fewer faces
+# on 3 of 9 images (3-faces 3 -> 2, 4to8 4 -> 2, 5to10 7 -> 3), so shrinking stays opt-in
+FACE_DETECTION_SCALE = float(os.getenv("IMGSERVE_FACE_DETECTION_SCALE", "1.0"))
+# images are never shrunk for detection below this many pixels on their short side, so small faces in small images are still found
+FACE_DETECTION_MIN_SIDE = 300
+
 
 class NotAnImageError(Exception):
     pass
 
 
+@dataclass
+class FaceCrop:
+    """ a face cropped by facechop with encode set, path is only set when the crop was also written to disk """
+    jpeg: bytes
+    box: Tuple[int, int, int, int]
+    path: Optional[Path] = None
+
+    @property
+    def bounding_box(self) -> Dict[str, int]:
+        x, y, width, height = self.box
+        return {"x": x, "y": y, "width": width, "height": height}
+
+
 def scale_image(img: cv2.Image, target_height: int = 500) -> cv2.Image:
     """ fit height box """
     height, width = img.shape[:2]
@@ -25,34 +54,225 @@ def scale_image(img: cv2.Image, target_height: int = 500) -> cv2.Image:
     return cv2.resize(img, (int(height_ratio*width), int(height_ratio*height)), interpolation = cv2.INTER_CUBIC)
 
 
-def facechop(image: Path, output_dir: Path, face_classifier: cv2.CascadeClassifier = FACE_CLASSIFIER, cv2_cascade_min_neighbors: int = 5) -> Generator[Path, None, None]:
+class DetectionCache:
+    """
+        Faces detected in each image, keyed by the image's content hash and the detector parameters, in a local SQLite file.
+        The same image comes back for many queries, trials and hosts, facechop only runs detection on images it has not seen.
+        Safe to share between threads, and between processes each with their own DetectionCache on the same path.
+    """
+
+    def __init__(self, path: Path, classifier_xml: str = FACE_CLASSIFIER_XML) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.path = path
+        self.classifier_sha256 = hashlib.sha256(Path(classifier_xml).read_bytes()).hexdigest()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS detections (image_sha256 TEXT, classifier_sha256 TEXT, min_neighbors INTEGER, detection_scale REAL, boxes TEXT, "
+            "PRIMARY KEY (image_sha256, classifier_sha256, min_neighbors, detection_scale))"
+        )
+
+    def get(self, image_sha256: str, min_neighbors: int, detection_scale: float) -> Optional[List[Tuple[int, int, int, int]]]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT boxes FROM detections WHERE image_sha256 = ? AND classifier_sha256 = ? AND min_neighbors = ? AND detection_scale = ?",
+                (image_sha256, self.classifier_sha256, min_neighbors, detection_scale),
+            ).fetchone()
+        if row is None:
+            return None
+        return [tuple(box) for box in json.loads(row[0])]
+
+    def put(self, image_sha256: str, min_neighbors: int, detection_scale: float, boxes: List[Tuple[int, int, int, int]]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?)",
+                (image_sha256, self.classifier_sha256, min_neighbors, detection_scale, json.dumps([list(box) for box in boxes])),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def detection_frame(img: cv2.Image, detection_scale: float = FACE_DETECTION_SCALE) -> Tuple[cv2.Image, float]:
+    """ grayscale, downscaled copy of img to run face detection on, and the scale it was shrunk by """
+    height, width = img.shape[:2]
+    scale = min(1.0, max(detection_scale, FACE_DETECTION_MIN_SIDE / min(height, width)))
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if scale == 1.0:
+        return gray, scale
+    minisize = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(gray, minisize, interpolation=cv2.INTER_AREA), scale
+
+
+def detect_faces(img: cv2.Image, face_classifier: cv2.CascadeClassifier, cv2_cascade_min_neighbors: int, detection_scale: float) -> List[Tuple[int, int, int, int]]:
+    """ bounding boxes (x, y, width, height) of the faces in img, in full size image coordinates """
+    miniframe, scale = detection_frame(img, detection_scale=detection_scale)
+
+    faces = face_classifier.detectMultiScale(miniframe, minNeighbors=cv2_cascade_min_neighbors)
+
+    # map the boxes found on the miniframe back onto the full size image
+    return [tuple(int(round(v / scale)) for v in f) for f in faces]
+
+
+def facechop(image: Path, output_dir: Optional[Path], face_classifier: cv2.CascadeClassifier = FACE_CLASSIFIER, cv2_cascade_min_neighbors: int = 5, detection_scale: float = FACE_DETECTION_SCALE, encode: bool = False, detection_cache: Optional[DetectionCache] = None) -> Generator[Union[Path, FaceCrop], None, None]:
+    """
+        Crop each face found in image, writing the crops to output_dir and yielding their paths.
+        With encode set, yields a FaceCrop holding the JPEG bytes and bounding box of each face instead,
+        and output_dir may be None to skip writing crops to disk altogether.
+        detection_cache must have been created for the classifier XML that face_classifier was loaded from.
+    """
+
+    if output_dir is None and not encode:
+        raise ValueError("facechop needs an output_dir to write crops to, unless encode is set")
 
     if not image.is_file():
         raise FileNotFoundError(image)
 
     log = simple_logger("imgserve.facechop")
 
-    img = cv2.imread(str(image))
+    image_bytes = image.read_bytes()
+    faces = None
+    if detection_cache is not None:
+        image_sha256 = hashlib.sha256(image_bytes).hexdigest()
+        faces = detection_cache.get(image_sha256, cv2_cascade_min_neighbors, detection_scale)
+        if faces is not None and len(faces) == 0:
+            # most images have no faces, those don't even need decoding
+            return
+
+    img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
 
     if img is None:
         raise NotAnImageError(f"file exists, but is not an image.")
-    minisize = (img.shape[1], img.shape[0])
-    miniframe = cv2.resize(img, minisize)
 
-    faces = face_classifier.detectMultiScale(miniframe, minNeighbors=cv2_cascade_min_neighbors)
+    if faces is None:
+        faces = detect_faces(img, face_classifier, cv2_cascade_min_neighbors, detection_scale)
+        if detection_cache is not None:
+            detection_cache.put(image_sha256, cv2_cascade_min_neighbors, detection_scale, faces)
 
     count = 0
     padding_pct = 0.2
     for f in faces:
-        x, y, w, h = [ v for v in f ]
+        x, y, w, h = f
         padding = int(h * padding_pct)
         cv2.rectangle(img, (x,y), (x+w+padding,y+h+padding), (255,255,255))
-        sub_face = img[y:y+h, x:x+w]
+        sub_face = scale_image(img[y:y+h, x:x+w])
 
-        output_dir.mkdir(exist_ok=True, parents=True)
-        cropped_face_image: Path = output_dir.joinpath(image.stem + f"-{count}").with_suffix(".jpg")
-        log.debug(f"writing {cropped_face_image}")
-        cv2.imwrite(str(cropped_face_image), scale_image(sub_face))
+        cropped_face_image: Optional[Path] = None
+        if output_dir is not None:
+            output_dir.mkdir(exist_ok=True, parents=True)
+            cropped_face_image = output_dir.joinpath(image.stem + f"-{count}").with_suffix(".jpg")
 
-        yield cropped_face_image
+        if encode:
+            encoded, jpeg = cv2.imencode(".jpg", sub_face)
+            if not encoded:
+                raise NotAnImageError(f"could not encode face {count} of {image}")
+            if cropped_face_image is not None:
+                log.debug(f"writing {cropped_face_image}")
+                cropped_face_image.write_bytes(jpeg.tobytes())
+            yield FaceCrop(jpeg=jpeg.tobytes(), box=(x, y, w, h), path=cropped_face_image)
+        else:
+            log.debug(f"writing {cropped_face_image}")
+            cv2.imwrite(str(cropped_face_image), sub_face)
+            yield cropped_face_image
         count += 1
+
+
+@dataclass
+class FaceExtraction:
+    image: Path
+    faces: List[Union[Path, FaceCrop]]
+    error: Optional[Exception] = None
+
+
+# each worker process loads its own classifier and opens its own detection cache once, in _load_worker_classifier
+_WORKER_CLASSIFIER: Optional[cv2.CascadeClassifier] = None
+_WORKER_DETECTION_CACHE: Optional[DetectionCache] = None
+
+
+def _load_worker_classifier(classifier_xml: str, detection_cache_path: Optional[Path]) -> None:
+    global _WORKER_CLASSIFIER, _WORKER_DETECTION_CACHE
+    _WORKER_CLASSIFIER = cv2.CascadeClassifier(classifier_xml)
+    if detection_cache_path is not None:
+        _WORKER_DETECTION_CACHE = DetectionCache(detection_cache_path, classifier_xml=classifier_xml)
+
+
+def _worker_started() -> None:
+    pass
+
+
+def _extract_faces(image: Path, output_dir: Optional[Path], face_classifier: cv2.CascadeClassifier, cv2_cascade_min_neighbors: int, detection_scale: float, encode: bool, detection_cache: Optional[DetectionCache]) -> FaceExtraction:
+    try:
+        return FaceExtraction(image=image, faces=list(facechop(image, output_dir, face_classifier=face_classifier, cv2_cascade_min_neighbors=cv2_cascade_min_neighbors, detection_scale=detection_scale, encode=encode, detection_cache=detection_cache)))
+    except (FileNotFoundError, NotAnImageError, cv2.error) as exc:
+        return FaceExtraction(image=image, faces=list(), error=exc)
+
+
+def _extract_faces_in_worker(image: Path, output_dir: Optional[Path], cv2_cascade_min_neighbors: int, detection_scale: float, encode: bool) -> FaceExtraction:
+    return _extract_faces(image, output_dir, _WORKER_CLASSIFIER, cv2_cascade_min_neighbors, detection_scale, encode, _WORKER_DETECTION_CACHE)
+
+
+class FaceExtractor:
+    """
+        Runs facechop over many images in a pool of worker processes, so face extraction scales with cores.
+        One extractor can be shared by several threads, e.g. the faces stage workers of run_trial.
+    """
+
+    def __init__(self, workers: Optional[int] = None, classifier_xml: str = FACE_CLASSIFIER_XML, cv2_cascade_min_neighbors: int = 5, detection_scale: float = FACE_DETECTION_SCALE, encode: bool = False, detection_cache_path: Optional[Path] = None) -> None:
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.cv2_cascade_min_neighbors = cv2_cascade_min_neighbors
+        self.detection_scale = detection_scale
+        # crops come back as FaceCrop, with their JPEG bytes, rather than as paths
+        self.encode = encode
+        self._executor = None
+        self._detection_cache = None
+        if self.workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_load_worker_classifier, initargs=(classifier_xml, detection_cache_path))
+            # workers are forked on the first submit, do that now, before the caller starts any threads:
+            # a child forked while another thread holds a lock (e.g. a logging handler's) can deadlock
+            self._executor.submit(_worker_started).result()
+        else:
+            if classifier_xml != FACE_CLASSIFIER_XML:
+                self._face_classifier = cv2.CascadeClassifier(classifier_xml)
+            else:
+                self._face_classifier = FACE_CLASSIFIER
+            if detection_cache_path is not None:
+                self._detection_cache = DetectionCache(detection_cache_path, classifier_xml=classifier_xml)
+
+    def __enter__(self) -> FaceExtractor:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._detection_cache is not None:
+            self._detection_cache.close()
+
+    def extract(self, jobs: Iterable[Tuple[Path, Optional[Path]]]) -> Generator[FaceExtraction, None, None]:
+        """
+            Extract the faces from each (image, output_dir) in jobs, yielding results in the order of jobs.
+            jobs is consumed lazily, at most a few images per worker are in flight at once.
+            An image that can not be read yields a FaceExtraction with its error, instead of raising.
+        """
+        if self._executor is None:
+            for image, output_dir in jobs:
+                yield _extract_faces(image, output_dir, self._face_classifier, self.cv2_cascade_min_neighbors, self.detection_scale, self.encode, self._detection_cache)
+            return
+
+        in_flight = deque()
+        for image, output_dir in jobs:
+            if len(in_flight) >= self.workers * 4:
+                yield in_flight.popleft().result()
+            in_flight.append(self._executor.submit(_extract_faces_in_worker, image, output_dir, self.cv2_cascade_min_neighbors, self.detection_scale, self.encode))
+        while len(in_flight) > 0:
+            yield in_flight.popleft().result()
+
+
+def facechop_many(jobs: Iterable[Tuple[Path, Path]], workers: Optional[int] = None, cv2_cascade_min_neighbors: int = 5, detection_cache_path: Optional[Path] = None) -> Generator[FaceExtraction, None, None]:
+    """ facechop each (image, output_dir) in jobs with a FaceExtractor of its own """
+    with FaceExtractor(workers=workers, cv2_cascade_min_neighbors=cv2_cascade_min_neighbors, detection_cache_path=detection_cache_path) as extractor:
+        yield from extractor.extract(jobs)
@@ -0,0 +1,83 @@
+from __future__ import annotations
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from .logger import simple_logger
+
+"""
+  Local record of trial progress, so an interrupted trial can resume without asking Elasticsearch what it already did
+"""
+
+log = simple_logger("imgserve.journal")
+
+TRIAL_STAGES = ["scrape", "faces", "vectors", "uploads", "index"]
+
+
+@dataclass
+class SearchProgress:
+    trial_timestamp: str
+    data_root: Path
+    stages: Set[str] = field(default_factory=set)
+
+
+class TrialJournal:
+    """
+        Append-only JSON lines file with one entry for each stage a search finished, keyed by (trial_id, hostname, search_term).
+        The whole journal is read once when opened, lookups after that are in memory.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._progress: Dict[Tuple[str, str, str], SearchProgress] = dict()
+        if path.is_file():
+            with open(path) as journal:
+                for line_number, line in enumerate(journal):
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError) as exc:
+                        # a line cut short by a crash, the stage it recorded will simply run again
+                        log.warning(f"skipping unreadable line {line_number} of {path}: {exc}")
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        key = (entry["trial_id"], entry["hostname"], entry["search_term"])
+        progress = self._progress.get(key)
+        if progress is None or progress.trial_timestamp != entry["trial_timestamp"]:
+            # a search started over under a new timestamp, earlier stages belong to the old attempt
+            progress = SearchProgress(
+                trial_timestamp=entry["trial_timestamp"], data_root=Path(entry["data_root"])
+            )
+            self._progress[key] = progress
+        progress.stages.add(entry["stage"])
+
+    def get(self, trial_id: str, hostname: str, search_term: str) -> Optional[SearchProgress]:
+        return self._progress.get((trial_id, hostname, search_term))
+
+    def record(
+        self,
+        trial_id: str,
+        hostname: str,
+        search_term: str,
+        trial_timestamp: str,
+        data_root: Path,
+        stage: str,
+    ) -> None:
+        if stage not in TRIAL_STAGES:
+            raise ValueError(f"{stage} is not one of {TRIAL_STAGES}")
+        entry = {
+            "trial_id": trial_id,
+            "hostname": hostname,
+            "search_term": search_term,
+            "trial_timestamp": trial_timestamp,
+            "data_root": str(data_root),
+            "stage": stage,
+            "recorded_at": time.time(),
+        }
+        with self._lock:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.path, "a") as journal:
+                journal.write(json.dumps(entry) + "\n")
+            self._apply(entry)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+import queue
+import threading
+from dataclasses import dataclass
+
+from .logger import simple_logger
+
+"""
+  Run items through a sequence of stages, each with its own worker threads, connected by bounded queues
+"""
+
+log = simple_logger("imgserve.pipeline")
+
+# placed on a stage's queue once no more items will arrive
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable[[Any], Optional[Any]]
+    workers: int = 1
+
+
+@dataclass
+class StageError:
+    stage: str
+    item: Any
+    exception: BaseException
+
+
+def run_pipeline(
+    items: Iterable[Any],
+    stages: List[Stage],
+    queue_size: int = 2,
+    describe: Callable[[Any], str] = str,
+) -> List[StageError]:
+    """
+        Feed items through stages in order. Each stage function takes the item returned by the previous stage,
+        and returns the item to pass on, or None to drop it. An exception drops the item and is collected in the
+        returned errors, so one failing item does not stop the others. At most queue_size items wait between stages.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    errors: List[StageError] = list()
+    errors_lock = threading.Lock()
+
+    def work(stage_number: int, stage: Stage) -> None:
+        inbox = queues[stage_number]
+        outbox = queues[stage_number + 1] if stage_number + 1 < len(queues) else None
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # let the other workers of this stage see it too
+                inbox.put(_DONE)
+                return
+            try:
+                result = stage.function(item)
+            except Exception as exc:
+                log.error(f"{stage.name} failed for {describe(item)}: {exc!r}")
+                log.debug(f"{stage.name} failed for {describe(item)}", exc_info=True)
+                with errors_lock:
+                    errors.append(StageError(stage=stage.name, item=item, exception=exc))
+                continue
+            if result is not None and outbox is not None:
+                outbox.put(result)
+
+    workers = list()
+    for stage_number, stage in enumerate(stages):
+        stage_workers = [
+            threading.Thread(
+                target=work,
+                args=(stage_number, stage),
+                name=f"imgserve-{stage.name}-{worker}",
+                daemon=True,
+            )
+            for worker in range(stage.workers)
+        ]
+        for thread in stage_workers:
+            thread.start()
+        workers.append(stage_workers)
+
+    try:
+        for item in items:
+            queues[0].put(item)
+    finally:
+        # drain each stage in order, a stage is done once every worker of the stage before it has returned
+        for stage_number, stage_workers in enumerate(workers):
+            queues[stage_number].put(_DONE)
+            for thread in stage_workers:
+                thread.join()
+
+    return errors
@@ -0,0 +1,155 @@
+from __future__ import annotations
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from tqdm import tqdm
+
+import botocore.exceptions
+
+from .logger import simple_logger
+
+"""
+  Resumable, concurrent mirroring of S3 objects to local storage
+"""
+
+log = simple_logger("imgserve.pull")
+
+
+class PullIndex:
+    """
+        Local SQLite index of the objects already pulled, with the ETag and size they had when pulled.
+        A re-run consults the index instead of statting each local file, so an interrupted pull resumes where it stopped.
+    """
+
+    def __init__(self, path: Path, commit_every: int = 500) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._connection = sqlite3.connect(str(path))
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, etag TEXT, size INTEGER, local_path TEXT, pulled_at REAL)"
+        )
+        self._connection.commit()
+
+    def __enter__(self) -> PullIndex:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get(self, key: str) -> Optional[Tuple[Optional[str], int]]:
+        return self._connection.execute(
+            "SELECT etag, size FROM objects WHERE key = ?", (key,)
+        ).fetchone()
+
+    def record(self, key: str, etag: Optional[str], size: int, local_path: Path) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)",
+            (key, etag, size, str(local_path), time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        self._connection.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._connection.close()
+
+
+def up_to_date(
+    indexed: Tuple[Optional[str], int], remote: Optional[Dict[str, Any]]
+) -> bool:
+    etag, size = indexed
+    if remote is None:
+        return True
+    if etag is None:
+        return size == remote["Size"]
+    return etag == remote["ETag"]
+
+
+def pull_s3_object(
+    s3_client: botocore.clients.s3, bucket: str, key: str, local_path: Path
+) -> Tuple[str, str, int, Path]:
+    obj = s3_client.get_object(Bucket=bucket, Key=key)
+    local_path.parent.mkdir(exist_ok=True, parents=True)
+    # write next to the destination and rename, so an interrupted pull never leaves a truncated file behind
+    partial_path = local_path.with_name(local_path.name + ".partial")
+    partial_path.write_bytes(obj["Body"].read())
+    partial_path.replace(local_path)
+    return key, obj.get("ETag"), obj["ContentLength"], local_path
+
+
+def pull_s3_objects(
+    s3_client: botocore.clients.s3,
+    bucket: str,
+    objects: Iterable[Tuple[str, Path]],
+    pull_index: PullIndex,
+    remote_objects: Optional[Dict[str, Dict[str, Any]]] = None,
+    workers: int = 8,
+    total: Optional[int] = None,
+    desc: str = "Pull",
+) -> Dict[str, str]:
+    """
+        Mirror each (key, local_path) in objects, skipping objects pull_index already has.
+        When remote_objects (from list_s3_objects) is passed, indexed objects whose ETag changed are pulled again.
+        Returns errors for objects that could not be pulled.
+    """
+    errors = dict()
+    pulled = 0
+    skipped = 0
+    in_flight = dict()
+
+    def collect(futures: Set[Future]) -> None:
+        nonlocal pulled
+        for future in futures:
+            key = in_flight.pop(future)
+            pbar.update(1)
+            try:
+                key, etag, size, local_path = future.result()
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError) as exc:
+                errors[key] = repr(exc)
+                continue
+            pull_index.record(key, etag, size, local_path)
+            pulled += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+        total=total, desc=desc
+    ) as pbar:
+        for key, local_path in objects:
+            remote = remote_objects.get(key) if remote_objects is not None else None
+            indexed = pull_index.get(key)
+            if indexed is None and local_path.is_file():
+                # pulled before the index existed, adopt the local file if it agrees with the listing
+                size = local_path.stat().st_size
+                if remote is None or remote["Size"] == size:
+                    pull_index.record(
+                        key, remote["ETag"] if remote is not None else None, size, local_path
+                    )
+                    indexed = (remote["ETag"] if remote is not None else None, size)
+            if indexed is not None and up_to_date(indexed, remote):
+                skipped += 1
+                pbar.update(1)
+                continue
+
+            if len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[
+                executor.submit(pull_s3_object, s3_client, bucket, key, local_path)
+            ] = key
+        collect(wait(in_flight).done)
+
+    pull_index.commit()
+    log.info(
+        f"pulled {pulled} objects, {skipped} already up to date"
+        + (f", {len(errors)} errors" if len(errors) > 0 else "")
+    )
+    for key, error in list(errors.items())[:5]:
+        log.error(f"could not pull {key}: {error}")
+    return errors
@@ -1,14 +1,64 @@
 from __future__ import annotations
 import io
+import itertools
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 
+import botocore.exceptions
 import PIL
+from retry import retry
+from tqdm import tqdm
 
 from .errors import S3Error
 from .logger import simple_logger
 
 log = simple_logger("imgserve.s3")
 
+# delete_objects accepts at most this many keys per request
+DELETE_OBJECTS_MAX_KEYS = 1000
+
+
+def list_s3_objects(
+    s3_client: botocore.clients.s3,
+    bucket: str,
+    prefix: str = "",
+    delimiter: Optional[str] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+        List every object under prefix with list_objects_v2, 1000 objects per call, keyed by Key.
+        Pass delimiter="/" to only list the objects directly under prefix.
+    """
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter is not None:
+        kwargs.update(Delimiter=delimiter)
+    objects = dict()
+    for page in s3_client.get_paginator("list_objects_v2").paginate(**kwargs):
+        objects.update((obj["Key"], obj) for obj in page.get("Contents", list()))
+    log.debug(f"{len(objects)} objects listed under s3://{bucket}/{prefix}")
+    return objects
+
+
+def list_s3_keys(
+    s3_client: botocore.clients.s3,
+    bucket: str,
+    prefix: str = "",
+    delimiter: Optional[str] = None,
+) -> Set[str]:
+    return set(list_s3_objects(s3_client, bucket, prefix=prefix, delimiter=delimiter))
+
+
+def s3_object_exists(
+    s3_client: botocore.clients.s3, bucket: str, object_path: Path
+) -> bool:
+    try:
+        s3_client.head_object(Bucket=bucket, Key=str(object_path))
+        return True
+    except botocore.exceptions.ClientError as exc:
+        if exc.response.get("Error", dict()).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+            return False
+        raise
+
 
 def s3_put_image(
     s3_client: botocore.clients.s3,
@@ -16,30 +66,38 @@ def s3_put_image(
     bucket: str,
     object_path: Path,
     overwrite: bool = False,
+    known_keys: Optional[Set[str]] = None,
 ) -> None:
-
-    if isinstance(image, PIL.Image.Image):
-        image_bytes = io.BytesIO()
-        image.save(image_bytes, format="PNG")
-        image_bytes = image_bytes.getvalue()
-    elif isinstance(image, Path):
-        image_bytes = image.read_bytes()
-    elif isinstance(image, bytes):
-        image_bytes = image
-    else:
-        raise ValueError(f"{image} is not a known type")
+    """
+        Upload image to object_path, unless it already exists there and overwrite is not set.
+        known_keys, e.g. from list_s3_keys, answers existence checks without a request to S3, and is updated with each upload.
+    """
 
     try:
         # only write images to s3 that don't already exist unless overwrite is passed
-        try:
-            s3_client.get_object(Bucket=bucket, Key=str(object_path))
-            if not overwrite:
+        if not overwrite:
+            if known_keys is not None:
+                exists = str(object_path) in known_keys
+            else:
+                exists = s3_object_exists(s3_client, bucket, object_path)
+            if exists:
                 log.debug(f"{object_path} already exists in s3, not overwriting")
                 return
-        except s3_client.exceptions.NoSuchKey:
-            pass
+
+        if isinstance(image, PIL.Image.Image):
+            image_bytes = io.BytesIO()
+            image.save(image_bytes, format="PNG")
+            image_bytes = image_bytes.getvalue()
+        elif isinstance(image, Path):
+            image_bytes = image.read_bytes()
+        elif isinstance(image, bytes):
+            image_bytes = image
+        else:
+            raise ValueError(f"{image} is not a known type")
 
         s3_client.put_object(Body=image_bytes, Bucket=bucket, Key=str(object_path))
+        if known_keys is not None:
+            known_keys.add(str(object_path))
         log.info(f"uploaded {object_path} to s3.")
     except s3_client.exceptions.ClientError:
         s3_client_attributes = {
@@ -52,7 +110,167 @@ def s3_put_image(
         raise S3Error(f"{s3_client_attributes} S3 ClientError")
 
 
+class S3Uploader:
+    """
+        Upload images with s3_put_image on worker threads, so the caller can keep processing while uploads are in flight.
+        submit blocks once max_pending uploads are queued. PIL images are encoded on the workers.
+        Call flush before indexing documents that refer to the uploaded images, it is safe to call from several threads.
+    """
+
+    def __init__(
+        self,
+        s3_client: botocore.clients.s3,
+        bucket: str,
+        workers: int = 8,
+        max_pending: int = 64,
+        known_keys: Optional[Set[str]] = None,
+    ) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.known_keys = known_keys
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="imgserve-s3-upload"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures: Dict[Future, Path] = dict()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> S3Uploader:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def submit(
+        self,
+        image: Union[PIL.Image, Path, bytes],
+        object_path: Path,
+        overwrite: bool = False,
+        bucket: Optional[str] = None,
+        known_keys: Optional[Set[str]] = None,
+    ) -> Future:
+        self._slots.acquire()
+        future = self._executor.submit(
+            s3_put_image,
+            s3_client=self.s3_client,
+            image=image,
+            bucket=bucket if bucket is not None else self.bucket,
+            object_path=object_path,
+            overwrite=overwrite,
+            known_keys=known_keys if known_keys is not None else self.known_keys,
+        )
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._futures[future] = object_path
+        return future
+
+    def flush(self, futures: Optional[Iterable[Future]] = None) -> None:
+        """
+            wait for every submitted upload, or only for futures, raising S3Error if any of them failed
+        """
+        with self._lock:
+            if futures is None:
+                futures, self._futures = self._futures, dict()
+            else:
+                futures = {
+                    future: self._futures.pop(future, None) for future in futures
+                }
+        wait(futures)
+        failed = {
+            object_path: future.exception()
+            for future, object_path in futures.items()
+            if future.exception() is not None
+        }
+        if len(failed) > 0:
+            raise S3Error(
+                f"{len(failed)} of {len(futures)} uploads failed: "
+                + ", ".join(f"{object_path} ({exc})" for object_path, exc in failed.items())
+            )
+        log.debug(f"flushed {len(futures)} uploads")
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+@retry(
+    exceptions=(
+        botocore.exceptions.ReadTimeoutError,
+        botocore.exceptions.ConnectionError,
+    ),
+    tries=5,
+    backoff=2,
+    delay=1,
+)
 def get_s3_bytes(
     s3_client: botocore.clients.s3, bucket_name: str, s3_path: Path
 ) -> bytes:
     return s3_client.get_object(Bucket=bucket_name, Key=str(s3_path))["Body"].read()
+
+
+@retry(
+    exceptions=(botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError),
+    tries=5,
+    backoff=2,
+    delay=1,
+)
+def _delete_objects(
+    s3_client: botocore.clients.s3, bucket: str, batch: List[str]
+) -> Dict[str, Any]:
+    return s3_client.delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+    )
+
+
+def delete_s3_objects(
+    s3_client: botocore.clients.s3,
+    bucket: str,
+    keys: Iterable[str],
+    total: Optional[int] = None,
+    workers: int = 8,
+    desc: str = "Delete",
+) -> Dict[str, str]:
+    """
+        Delete keys with delete_objects calls of up to 1000 keys each, sending up to workers calls concurrently.
+        Returns the per-key errors reported by S3, including every key of a call that still failed after retries (e.g. SlowDown).
+    """
+
+    def delete_batch(batch: List[str]) -> Tuple[int, Dict[str, str]]:
+        try:
+            resp = _delete_objects(s3_client, bucket, batch)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as exc:
+            return len(batch), {key: repr(exc) for key in batch}
+        return len(batch), {
+            error["Key"]: f"{error.get('Code')}: {error.get('Message')}"
+            for error in resp.get("Errors", list())
+        }
+
+    errors = dict()
+    keys = iter(keys)
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+        total=total, desc=desc
+    ) as pbar:
+        in_flight = set()
+        while True:
+            batch = list(itertools.islice(keys, DELETE_OBJECTS_MAX_KEYS))
+            if len(batch) > 0:
+                in_flight.add(executor.submit(delete_batch, batch))
+            # bound the keys held in memory while the key stream is consumed
+            if len(in_flight) >= workers * 2 or (len(batch) == 0 and len(in_flight) > 0):
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    deleted, batch_errors = future.result()
+                    errors.update(batch_errors)
+                    pbar.update(deleted)
+            if len(batch) == 0 and len(in_flight) == 0:
+                break
+
+    if len(errors) > 0:
+        log.error(
+            f"{len(errors)} keys could not be deleted from s3://{bucket}, for example: "
+            + ", ".join(f"{key} ({error})" for key, error in itertools.islice(errors.items(), 5))
+        )
+    return errors
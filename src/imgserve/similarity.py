@@ -0,0 +1,145 @@
+from __future__ import annotations
+from pathlib import Path
+
+import numpy as np
+
+from .logger import simple_logger
+
+"""
+  Nearest-neighbour queries over the colour distributions of colorgram documents
+"""
+
+log = simple_logger("imgserve.similarity")
+
+METRICS = ["js", "cosine"]
+
+# rows of the index compared against a batch of queries at once, bounds the memory of the (queries x rows x bins) intermediate
+ROWS_PER_BATCH = 4096
+
+
+def normalize(distributions: numpy.ndarray) -> numpy.ndarray:
+    """ rows as probability distributions, NaN bins count as empty """
+    distributions = np.nan_to_num(np.asarray(distributions, dtype=np.float64), nan=0.0)
+    totals = distributions.sum(axis=-1, keepdims=True)
+    return np.divide(distributions, totals, out=np.zeros_like(distributions), where=totals > 0)
+
+
+def js_divergence(queries: numpy.ndarray, rows: numpy.ndarray) -> numpy.ndarray:
+    """ Jensen-Shannon divergence (base 2, between 0 and 1) of each normalized query against each normalized row """
+    p = queries[:, np.newaxis, :]
+    q = rows[np.newaxis, :, :]
+    m = (p + q) / 2
+
+    def kl(a: numpy.ndarray) -> numpy.ndarray:
+        ratio = np.divide(a, m, out=np.ones_like(m), where=a > 0)
+        return (a * np.log2(ratio)).sum(axis=-1)
+
+    return (kl(p) + kl(q)) / 2
+
+
+def cosine_distance(queries: numpy.ndarray, rows: numpy.ndarray) -> numpy.ndarray:
+    query_norms = np.linalg.norm(queries, axis=-1, keepdims=True)
+    row_norms = np.linalg.norm(rows, axis=-1, keepdims=True)
+    queries = np.divide(queries, query_norms, out=np.zeros_like(queries), where=query_norms > 0)
+    rows = np.divide(rows, row_norms, out=np.zeros_like(rows), where=row_norms > 0)
+    return 1 - queries @ rows.T
+
+
+class SimilarityIndex:
+    """
+        Colour distributions of every colorgram of an experiment, one normalized row per colorgram,
+        with the query (word) and s3_key of each row. Saved to and loaded from a single .npz file.
+        colorgrams is how many colorgram documents the index was built from, including those without field,
+        so callers can tell whether colorgrams were added since.
+    """
+
+    def __init__(self, words: List[str], s3_keys: List[str], distributions: numpy.ndarray, field: str = "jzazbz_dist", colorgrams: Optional[int] = None) -> None:
+        self.words = np.asarray(words, dtype=str)
+        self.s3_keys = np.asarray(s3_keys, dtype=str)
+        self.distributions = normalize(distributions)
+        self.field = field
+        self.colorgrams = colorgrams if colorgrams is not None else len(self.words)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    @classmethod
+    def from_colorgrams(cls, colorgram_documents: Iterable[ColorgramDocument], field: str = "jzazbz_dist") -> SimilarityIndex:
+        words = list()
+        s3_keys = list()
+        distributions = list()
+        colorgrams = 0
+        for colorgram_document in colorgram_documents:
+            colorgrams += 1
+            if colorgram_document.source.get(field) is None:
+                continue
+            words.append(colorgram_document.source["query"])
+            s3_keys.append(colorgram_document.source["s3_key"])
+            # None marks NaN bins, see vectors.array_to_list
+            distributions.append(np.array(colorgram_document.source[field], dtype=float))
+        if len(distributions) == 0:
+            raise ValueError(f"no colorgram documents with {field} to index")
+        return cls(words=words, s3_keys=s3_keys, distributions=np.stack(distributions), field=field, colorgrams=colorgrams)
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, "wb") as f:
+            np.savez(f, words=self.words, s3_keys=self.s3_keys, distributions=self.distributions, field=np.array(self.field), colorgrams=np.array(self.colorgrams))
+
+    @classmethod
+    def load(cls, path: Path) -> SimilarityIndex:
+        with np.load(path) as npz:
+            return cls(
+                words=npz["words"],
+                s3_keys=npz["s3_keys"],
+                distributions=npz["distributions"],
+                field=str(npz["field"]),
+                # indexes saved before colorgrams was recorded count as stale
+                colorgrams=int(npz["colorgrams"]) if "colorgrams" in npz.files else -1,
+            )
+
+    def distances(self, queries: numpy.ndarray, metric: str = "js") -> numpy.ndarray:
+        """ (queries x rows) distances from each of queries to every row of the index """
+        if metric not in METRICS:
+            raise ValueError(f"{metric} is not one of {METRICS}")
+        queries = normalize(np.atleast_2d(queries))
+        distance = js_divergence if metric == "js" else cosine_distance
+        return np.concatenate(
+            [
+                distance(queries, self.distributions[start : start + ROWS_PER_BATCH])
+                for start in range(0, len(self), ROWS_PER_BATCH)
+            ],
+            axis=1,
+        )
+
+    def nearest(self, queries: numpy.ndarray, k: int = 10, metric: str = "js", exclude: Optional[List[Set[int]]] = None) -> List[List[Tuple[int, float]]]:
+        """ the k nearest (row, distance) to each of queries, closest first, leaving out the rows in exclude[i] for query i """
+        distances = self.distances(queries, metric=metric)
+        results = list()
+        for query_number, query_distances in enumerate(distances):
+            excluded = exclude[query_number] if exclude is not None else set()
+            # partial sort enough rows to still have k left after exclusions
+            candidates = min(len(query_distances), k + len(excluded))
+            nearest_rows = np.argpartition(query_distances, candidates - 1)[:candidates]
+            nearest_rows = nearest_rows[np.argsort(query_distances[nearest_rows], kind="stable")]
+            results.append(
+                [(int(row), float(query_distances[row])) for row in nearest_rows if row not in excluded][:k]
+            )
+        return results
+
+    def similar_words(self, word: str, k: int = 10, metric: str = "js") -> List[Dict[str, Any]]:
+        """ the k colorgrams closest to the colorgrams of word, excluding word's own """
+        rows = np.flatnonzero(self.words == word)
+        if len(rows) == 0:
+            raise KeyError(word)
+        own_rows = set(int(row) for row in rows)
+        return [
+            {
+                "query": word,
+                "similar": [
+                    {"word": str(self.words[row]), "s3_key": str(self.s3_keys[row]), "distance": distance}
+                    for row, distance in nearest
+                ],
+            }
+            for nearest in self.nearest(self.distributions[rows], k=k, metric=metric, exclude=[own_rows] * len(rows))
+        ]
@@ -1,10 +1,14 @@
 from __future__ import annotations
+import contextlib
 import copy
+import dataclasses
 import hashlib
 import json
 import shlex
 import shutil
 import subprocess
+from concurrent.futures import Future
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 
@@ -12,24 +16,108 @@ from retry import retry
 
 from .api import CroppedFaceImageDocument
 from .elasticsearch import (
-    document_exists,
+    existing_documents,
     index_to_elasticsearch,
     COLORGRAMS_INDEX_PATTERN,
     CROPPED_FACE_INDEX_PATTERN,
     MTURK_HITS_INDEX_PATTERN,
     RAW_IMAGES_INDEX_PATTERN,
 )
-from .errors import UnimplementedError
+from .errors import BulkIndexingError, UnimplementedError
+from .journal import TrialJournal
 from .logger import simple_logger
-from .s3 import s3_put_image
-from .utils import get_batch_slice
-from .vectors import get_vectors
-from .faces import facechop
+from .pipeline import Stage, run_pipeline
+from .s3 import list_s3_keys, S3Uploader
+from .utils import get_batch_slice, link_file
+from .vectors import get_vectors, save_distributions
+from .faces import FaceExtractor, FACE_DETECTION_SCALE
 
 QUERY_RUNNER_IMAGE = "mgraskertheband/qloader:4.6.2"
 
+# filled in for each search by run_query, run_trial accepts another template to replace the container, e.g. with a stub command in tests
+QUERY_RUNNER_COMMAND = " ".join(
+    [
+        "docker run",
+        "--user 1000:1000",
+        "--shm-size=2g",
+        "--name {container_name}",
+        "-v {data_root}:/tmp/imgserve",
+        "--rm",
+        "--env QLOADER_BROWSER=Firefox",
+        "--env S3_ACCESS_KEY_ID={s3_access_key_id}",
+        "--env S3_SECRET_ACCESS_KEY={s3_secret_access_key}",
+        "--env S3_ENDPOINT_URL={s3_endpoint_url}",
+        "--env S3_REGION_NAME={s3_region_name}",
+        "--env S3_BUCKET_NAME={s3_bucket_name}",
+        "{query_runner_image}",
+        "--trial-id {trial_id}",
+        "--hostname {hostname}",
+        "--ran-at {trial_timestamp}",
+        "--endpoint {endpoint}",
+        '--query-terms "{search_term}"',
+        "--max-images {max_images}",
+        "--output-path /tmp/imgserve/",
+        "--metadata-path /tmp/imgserve/{trial_id}/.metadata-{trial_timestamp}.json",
+        "{extra_args}",
+    ]
+)
+
+
+@dataclass
+class TrialSearch:
+    """ state of one search term as it moves through the run_trial pipeline """
+
+    search_term: str
+    trial_id: str
+    trial_hostname: str
+    trial_timestamp: str
+    image_document_shared: Dict[str, Any]
+    # each search gets its own data root, mounted into its query runner, so concurrent searches never share a manifest, metadata file or images folder
+    data_root: Path
+    face_documents: List[Dict[str, Any]] = dataclasses.field(default_factory=list)
+    colorgram_documents: List[Dict[str, Any]] = dataclasses.field(default_factory=list)
+    uploads: List[Future] = dataclasses.field(default_factory=list)
+    # stages the trial journal says this search already finished, in an earlier run of the trial
+    completed: Set[str] = dataclasses.field(default_factory=set)
+
+    @property
+    def query_downloads(self) -> Path:
+        return (
+            self.data_root.joinpath(self.trial_id)
+            .joinpath(self.trial_hostname)
+            .joinpath(self.trial_timestamp)
+        )
+
+    @property
+    def manifest(self) -> Path:
+        return self.query_downloads.joinpath("manifest.json")
+
+    @property
+    def metadata_log(self) -> Path:
+        return self.data_root.joinpath(self.trial_id).joinpath(
+            f".metadata-{self.trial_timestamp}.json"
+        )
+
+    @property
+    def face_documents_file(self) -> Path:
+        return self.data_root.joinpath("face-documents.json")
+
+    @property
+    def colorgram_documents_file(self) -> Path:
+        return self.data_root.joinpath("colorgram-documents.json")
+
+    def resumes(self, *stages: str) -> bool:
+        """ True when every one of stages finished in an earlier run of the trial """
+        return all(stage in self.completed for stage in stages)
 
-@retry(tries=5, backoff=2, delay=1)
+    @property
+    def container_name(self) -> str:
+        return "imgserve-query-" + hashlib.sha256(
+            str(self.data_root).encode("utf-8")
+        ).hexdigest()[:16]
+
+
+@retry(subprocess.CalledProcessError, tries=5, backoff=2, delay=1)
 def run_search(docker_run_command: str, timeout: int) -> None:
     log = simple_logger("imgserve.subprocess")
     proc = subprocess.run(
@@ -42,6 +130,83 @@ def run_search(docker_run_command: str, timeout: int) -> None:
         raise subprocess.CalledProcessError(proc.returncode, docker_run_command)
 
 
+def run_query(
+    search: TrialSearch,
+    query_runner_command: str = QUERY_RUNNER_COMMAND,
+    timeout: int = 600,
+    **command_fields: Any,
+) -> TrialSearch:
+    """
+        Run the query runner for one search, and check that it created a manifest.
+        command_fields fill in the parts of query_runner_command that are shared by every search of the trial.
+    """
+    log = simple_logger("imgserve.run_query")
+    search.metadata_log.parent.mkdir(exist_ok=True, parents=True)
+    search.metadata_log.write_text(json.dumps(search.image_document_shared, indent=2))
+
+    command = query_runner_command.format(
+        container_name=search.container_name,
+        data_root=search.data_root,
+        search_term=search.search_term,
+        trial_id=search.trial_id,
+        hostname=search.trial_hostname,
+        trial_timestamp=search.trial_timestamp,
+        **command_fields,
+    )
+    log.info(f"running query runner for query: {search.search_term}")
+    try:
+        run_search(command, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        if command.startswith("docker run"):
+            # killing the docker client leaves the container running, stop it so timed out searches don't pile up
+            subprocess.run(
+                ["docker", "kill", search.container_name], capture_output=True
+            )
+        raise
+
+    if not search.manifest.is_file():
+        from .pathtree import DisplayablePath
+
+        paths = DisplayablePath.make_tree(search.data_root)
+
+        raise FileNotFoundError(
+            "\n".join(
+                [
+                    f"The trial run should have created a manifest file at {search.manifest}, but it did not!",
+                    f"here's what was at {search.data_root}:",
+                    "\n".join([path.displayable() for path in paths]),
+                ]
+            )
+        )
+    return search
+
+
+def indexed_search_terms(
+    elasticsearch_client: Elasticsearch, trial_id: str, hostname: str, search_terms: List[str]
+) -> Set[str]:
+    """ which of search_terms already have raw-images indexed from hostname for trial_id, with one batched lookup """
+    hits = existing_documents(
+        elasticsearch_client,
+        [
+            {"hostname": hostname, "query": search_term, "trial_id": trial_id}
+            for search_term in search_terms
+        ],
+        index=RAW_IMAGES_INDEX_PATTERN,
+        identity_fields=["hostname", "query", "trial_id"],
+    )
+    return {hit["_source"]["query"] for hit in hits}
+
+
+def search_failures(errors: List[StageError]) -> Dict[str, str]:
+    """
+        The stage and error of each search that did not complete, by search term, including query runners that
+        timed out or exited non-zero. Callers must treat a non-empty result as a failed trial.
+    """
+    return {
+        error.item.search_term: f"{error.stage}: {error.exception!r}" for error in errors
+    }
+
+
 def run_trial(
     elasticsearch_client: Elasticsearch,
     experiment_name: str,
@@ -77,14 +242,33 @@ def run_trial(
     mturk_s3_bucket_name: Optional[str] = None,
     mturk_s3_region: Optional[str] = None,
     skip_vectors: bool = False,
+    distribution_sidecars: bool = False,
     query_timeout: int = 600,
     no_compress: bool = False,
     cv2_cascade_min_neighbors: int = 5,
-) -> None:
+    face_detection_scale: Optional[float] = None,
+    link_strategy: str = "hardlink",
+    upload_workers: int = 8,
+    face_detection_workers: int = 1,
+    face_processes: Optional[int] = None,
+    vector_workers: int = 1,
+    index_workers: int = 1,
+    pipeline_queue_size: int = 2,
+    parallel_queries: int = 1,
+    query_runner_command: str = QUERY_RUNNER_COMMAND,
+) -> Dict[str, str]:
     """
         Wrapper around github.com/mgrasker/qloader containerized search gatherer.
         Results are uploaded to S3 in the container, this method will handle indexing the raw image metadata to elasticsearch.
         This method also implements logic for face extraction and mturk HIT creation from the gathered images.
+
+        Search terms move through a pipeline of stages (scrape, faces, vectors, index) connected by bounded queues,
+        so one term can be scraped while earlier terms are processed, and parallel_queries query runners can be in flight at once.
+        Returns the failures (including timeouts) of each search term that did not complete.
+
+        Each stage a search finishes is recorded in a journal under local_data_store. With skip_already_searched,
+        a restarted trial skips searches the journal has as indexed, and resumes the others from their first unfinished stage.
+        Searches missing from the journal are skipped if their raw-images are in Elasticsearch.
     """
     log = simple_logger("imgserve.run_trial")
     trial_timestamp = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -103,208 +287,319 @@ def run_trial(
     else:
         trial_slice = trial_config_items
 
-    # for each search_term in csv, launch docker query
-    # TODO: optional "user browser" query
-    for search_term, csv_metadata in trial_slice:
-
-        if search_term.strip() == "":
-            continue
-
-        if skip_already_searched and document_exists(
-            elasticsearch_client=elasticsearch_client,
-            doc={
-                "hostname": trial_hostname,
-                "query": search_term,
-                "trial_id": trial_id,
-            },
-            index="raw-images",
-            identity_fields=["hostname", "query", "trial_id"],
-        ):
-            log.info(f"already searched {search_term} from this host for {trial_id}")
-            continue
-
-        regions = csv_metadata.pop("regions")
-
-        if dry_run:
-            log.info(f"[DRY RUN] would run search {search_term}")
-            continue
-
-        image_document_shared = copy.deepcopy(shared_metadata)
-        image_document_shared.update({"region": trial_hostname})
-        image_document_shared.update(csv_metadata)
-        search_metadata_log = local_data_store.joinpath(trial_id).joinpath(
-            f".metadata-{trial_timestamp}.json"
-        )
-        search_metadata_log.parent.mkdir(exist_ok=True, parents=True)
-        search_metadata_log.write_text(json.dumps(image_document_shared, indent=2))
-        if run_user_browser_scrape:
-            raise UnimplementedError()
-        else:
-            log.info(f"running {QUERY_RUNNER_IMAGE} for query: {search_term}")
-            docker_run_command = f'docker run \
-                --user 1000:1000 \
-                --shm-size=2g \
-                -v {local_data_store}:/tmp/imgserve \
-                --rm \
-                --env QLOADER_BROWSER=Firefox \
-                --env S3_ACCESS_KEY_ID={s3_access_key_id} \
-                --env S3_SECRET_ACCESS_KEY={s3_secret_access_key} \
-                --env S3_ENDPOINT_URL={s3_endpoint_url} \
-                --env S3_REGION_NAME={s3_region_name} \
-                --env S3_BUCKET_NAME={s3_bucket_name} \
-                {QUERY_RUNNER_IMAGE} \
-                    --trial-id {trial_id} \
-                    --hostname {trial_hostname} \
-                    --ran-at {trial_timestamp} \
-                    --endpoint {endpoint} \
-                    --query-terms "{search_term}" \
-                    --max-images {max_images} \
-                    --output-path /tmp/imgserve/ \
-                    --metadata-path /tmp/imgserve/{trial_id}/.metadata-{trial_timestamp}.json'
-            #log.info(docker_run_command)
-            if no_compress:
-                docker_run_command += ' --no-compress'
-            try:
-                run_search(docker_run_command, timeout=query_timeout)
-            except subprocess.TimeoutExpired as e:
-                log.error(
-                    f"Query for {search_term} took longer than {query_timeout}, skipping."
-                )
-                continue
+    if run_user_browser_scrape:
+        # TODO: optional "user browser" query
+        raise UnimplementedError()
+    if not skip_mturk_raw_images:
+        raise UnimplementedError("Must implement MTurk HIT creation from raw images")
+    if not skip_vectors and not skip_mturk_colorgrams:
+        raise UnimplementedError(f"Must implement Mturk task creation from colorgram documents")
 
-        query_downloads = (
-            local_data_store.joinpath(trial_id)
-            .joinpath(trial_hostname)
-            .joinpath(trial_timestamp)
+    face_keys = None
+    if not skip_face_detection and not dry_run:
+        # list the experiment's faces once per trial, rather than checking each face with a request to S3
+        face_keys = list_s3_keys(
+            s3_client, mturk_s3_bucket_name, prefix=f"{experiment_name}/faces/"
         )
-        trial_run_manifest = query_downloads.joinpath("manifest.json")
-        (
-            local_data_store.joinpath(trial_id)
-            .joinpath(trial_hostname)
-            .joinpath(trial_timestamp)
-            .joinpath("manifest.json")
+
+    journal = TrialJournal(
+        local_data_store.joinpath("searches").joinpath(trial_id).joinpath("journal.jsonl")
+    )
+
+    already_indexed = set()
+    if skip_already_searched:
+        # searches the journal knows nothing about, e.g. from trials started before it was kept, or on a fresh local data store,
+        # count as searched if Elasticsearch has their raw-images, as they did before the journal
+        unjournaled = [
+            search_term
+            for search_term, _ in trial_slice
+            if search_term.strip() != "" and journal.get(trial_id, trial_hostname, search_term) is None
+        ]
+        if len(unjournaled) > 0:
+            already_indexed = indexed_search_terms(
+                elasticsearch_client, trial_id, trial_hostname, unjournaled
+            )
+
+    def finished(search: TrialSearch, stage: str) -> None:
+        journal.record(
+            trial_id=trial_id,
+            hostname=trial_hostname,
+            search_term=search.search_term,
+            trial_timestamp=search.trial_timestamp,
+            data_root=search.data_root,
+            stage=stage,
         )
-        if not trial_run_manifest.is_file():
-            from .pathtree import DisplayablePath
-
-            paths = DisplayablePath.make_tree(local_data_store)
-
-            raise FileNotFoundError(
-                "\n".join(
-                    [
-                        f"The trial run should have created a manifest file at {trial_run_manifest}, but it did not!",
-                        f"here's what was at {local_data_store}:",
-                        "\n".join([path.displayable() for path in paths]),
-                    ]
+
+    def searches() -> Generator[TrialSearch, None, None]:
+        for search_term, csv_metadata in trial_slice:
+
+            if search_term.strip() == "":
+                continue
+
+            progress = None
+            if skip_already_searched:
+                progress = journal.get(trial_id, trial_hostname, search_term)
+                if (progress is not None and "index" in progress.stages) or search_term in already_indexed:
+                    log.info(f"already searched {search_term} from this host for {trial_id}")
+                    continue
+
+            csv_metadata = dict(csv_metadata)
+            regions = csv_metadata.pop("regions")
+
+            if dry_run:
+                log.info(f"[DRY RUN] would run search {search_term}")
+                continue
+
+            image_document_shared = copy.deepcopy(shared_metadata)
+            image_document_shared.update({"region": trial_hostname})
+            image_document_shared.update(csv_metadata)
+            if progress is not None:
+                # pick the search up where the earlier run left it, under the timestamp its images were scraped with
+                log.info(f"resuming {search_term} after {', '.join(sorted(progress.stages))}")
+                image_document_shared.update(trial_timestamp=progress.trial_timestamp)
+                yield TrialSearch(
+                    search_term=search_term,
+                    trial_id=trial_id,
+                    trial_hostname=trial_hostname,
+                    trial_timestamp=progress.trial_timestamp,
+                    image_document_shared=image_document_shared,
+                    data_root=progress.data_root,
+                    completed=set(progress.stages),
                 )
+                continue
+            yield TrialSearch(
+                search_term=search_term,
+                trial_id=trial_id,
+                trial_hostname=trial_hostname,
+                trial_timestamp=trial_timestamp,
+                image_document_shared=image_document_shared,
+                data_root=local_data_store.joinpath("searches")
+                .joinpath(trial_id)
+                .joinpath(trial_timestamp)
+                .joinpath(hashlib.sha256(search_term.encode("utf-8")).hexdigest()[:16]),
             )
 
-        mturk_hit_documents = list()
+    def scrape(search: TrialSearch) -> TrialSearch:
+        if search.resumes("scrape") and search.manifest.is_file():
+            return search
+        # a fresh scrape invalidates whatever was derived from the previous one
+        search.completed.clear()
+        run_query(
+            search,
+            query_runner_command=query_runner_command,
+            timeout=query_timeout,
+            s3_access_key_id=s3_access_key_id,
+            s3_secret_access_key=s3_secret_access_key,
+            s3_endpoint_url=s3_endpoint_url,
+            s3_region_name=s3_region_name,
+            s3_bucket_name=s3_bucket_name,
+            query_runner_image=QUERY_RUNNER_IMAGE,
+            endpoint=endpoint,
+            max_images=max_images,
+            extra_args="--no-compress" if no_compress else "",
+        )
+        finished(search, "scrape")
+        return search
 
-        if not skip_face_detection:
-            face_documents = list()
-            updated_trial_run_manifest = list()
-            # iterate over manifest documents
-            for raw_image_doc in json.loads(trial_run_manifest.read_text()):
-                downloaded_image = query_downloads.joinpath("images").joinpath(f"{raw_image_doc['image_id']}.jpg")
-                face_count = 0
-                face_batch = list()
-                # facechop crops each face out of each image and creates a new file in a nested folder under 'faces'
-                for face_image in facechop(downloaded_image, downloaded_image.with_suffix("").joinpath("faces"), cv2_cascade_min_neighbors=cv2_cascade_min_neighbors):
-                    face_doc = {
-                        "image_id": downloaded_image.stem,
-                        "face_id": "-".join([downloaded_image.stem, str(len(face_batch))]),
-                        "query": search_term
-                    }
-                    face_doc.update(image_document_shared)
-                    s3_put_image(
-                        s3_client=s3_client,
-                        image=face_image,
+    # faces and vectors are only skipped once their uploads are known to have finished, otherwise they run again to resubmit them
+    def faces(search: TrialSearch) -> TrialSearch:
+        if skip_face_detection:
+            return search
+        if search.resumes("faces", "uploads") and search.face_documents_file.is_file():
+            search.face_documents = json.loads(search.face_documents_file.read_text())
+            return search
+
+        updated_trial_run_manifest = list()
+        raw_image_docs = json.loads(search.manifest.read_text())
+        downloaded_images = [
+            search.query_downloads.joinpath("images").joinpath(f"{raw_image_doc['image_id']}.jpg")
+            for raw_image_doc in raw_image_docs
+        ]
+        # facechop crops each face out of each image and encodes it in memory, results come back in manifest order.
+        # crops are also written to a nested folder under 'faces' when local data is kept
+        extractions = face_extractor.extract(
+            (downloaded_image, downloaded_image.with_suffix("").joinpath("faces") if not no_local_data else None)
+            for downloaded_image in downloaded_images
+        )
+        # iterate over manifest documents
+        for raw_image_doc, downloaded_image, extraction in zip(raw_image_docs, downloaded_images, extractions):
+            if extraction.error is not None:
+                log.warning(f"could not detect faces in {downloaded_image}: {extraction.error!r}")
+                updated_trial_run_manifest.append(raw_image_doc)
+                continue
+            face_batch = list()
+            for face_crop in extraction.faces:
+                face_doc = {
+                    "image_id": downloaded_image.stem,
+                    "face_id": "-".join([downloaded_image.stem, str(len(face_batch))]),
+                    "query": search.search_term,
+                    "bounding_box": face_crop.bounding_box,
+                }
+                face_doc.update(search.image_document_shared)
+                search.uploads.append(
+                    uploader.submit(
+                        image=face_crop.jpeg,
                         bucket=mturk_s3_bucket_name,
                         object_path=Path(experiment_name).joinpath("faces").joinpath(face_doc["face_id"]).with_suffix(".jpg"), # each unique face will have it's image bytes stored one time.
                         overwrite=False,
+                        known_keys=face_keys,
                     )
-                    face_batch.append(face_doc)
-                    face_documents.append(face_doc)
+                )
+                face_batch.append(face_doc)
+                search.face_documents.append(face_doc)
 
-                # update raw image document with information about faces contained
-                raw_image_doc.update(number_of_faces=len(face_batch))
-                updated_trial_run_manifest.append(raw_image_doc)
+            # update raw image document with information about faces contained
+            raw_image_doc.update(number_of_faces=len(face_batch))
+            updated_trial_run_manifest.append(raw_image_doc)
 
-            # finish face detection, update raw images data with metadata about faces
-            trial_run_manifest.write_text(json.dumps(updated_trial_run_manifest))
-            index_to_elasticsearch(
-                elasticsearch_client=elasticsearch_client,
-                index=CROPPED_FACE_INDEX_PATTERN,
-                docs=face_documents,
-                identity_fields=["face_id", "query"], # this makes it so that we only store each cropped face in elasticsearch once for the query that returned it.
-                overwrite=False
-            )
+        # finish face detection, update raw images data with metadata about faces
+        search.manifest.write_text(json.dumps(updated_trial_run_manifest))
+        search.face_documents_file.write_text(json.dumps(search.face_documents))
+        finished(search, "faces")
+        return search
 
-        if not skip_mturk_raw_images:
-            raise UnimplementedError("Must implement MTurk HIT creation from raw images")
-        index_to_elasticsearch(
-            elasticsearch_client=elasticsearch_client,
-            index=RAW_IMAGES_INDEX_PATTERN,
-            docs=json.loads(trial_run_manifest.read_text()),
-            identity_fields=["trial_id", "trial_hostname", "ran_at"],
-        )
-        if not skip_vectors:
-            vector_stem = f"query={search_term}|hostname={trial_hostname}|trial_timestamp={trial_timestamp}"
-            trial_downloads = query_downloads.joinpath("vector").joinpath(vector_stem)
-            try:
-                shutil.rmtree(
-                    trial_downloads
-                )  # clear existing downloads folders from previous runs
-            except FileNotFoundError:
-                pass
-            trial_downloads.mkdir(parents=True)
-            for downloaded_image in query_downloads.joinpath("images").glob("*.jpg"):
-                trial_downloads.joinpath(downloaded_image.name).write_bytes(
-                    downloaded_image.read_bytes()
-                )
-            documents = list()
-            for vector, metadata in get_vectors(trial_downloads.parent):
-                s3_put_image(
-                    s3_client=s3_client,
+    def vectors(search: TrialSearch) -> TrialSearch:
+        if skip_vectors:
+            return search
+        if search.resumes("vectors", "uploads") and search.colorgram_documents_file.is_file():
+            search.colorgram_documents = json.loads(search.colorgram_documents_file.read_text())
+            return search
+
+        vector_stem = f"query={search.search_term}|hostname={trial_hostname}|trial_timestamp={search.trial_timestamp}"
+        trial_downloads = search.query_downloads.joinpath("vector").joinpath(vector_stem)
+        try:
+            shutil.rmtree(
+                trial_downloads
+            )  # clear existing downloads folders from previous runs
+        except FileNotFoundError:
+            pass
+        trial_downloads.mkdir(parents=True)
+        for downloaded_image in search.query_downloads.joinpath("images").glob("*.jpg"):
+            link_file(
+                downloaded_image,
+                trial_downloads.joinpath(downloaded_image.name),
+                strategy=link_strategy,
+            )
+        for vector, metadata in get_vectors(trial_downloads.parent):
+            search.uploads.append(
+                uploader.submit(
                     image=vector.colorgram,
-                    bucket=s3_bucket_name,
                     object_path=Path(experiment_name).joinpath(metadata["s3_key"]),
                     overwrite=True,
                 )
-                metadata.update(experiment_name=experiment_name)
-                documents.append(metadata)
-                if not no_local_data:
-                    save_to = (
-                        trial_downloads.parents[1]
-                        .joinpath("colorgrams")
-                        .joinpath(vector_stem)
-                        .with_suffix(".png")
+            )
+            metadata.update(experiment_name=experiment_name)
+            search.colorgram_documents.append(metadata)
+            if not no_local_data:
+                save_to = (
+                    trial_downloads.parents[1]
+                    .joinpath("colorgrams")
+                    .joinpath(vector_stem)
+                    .with_suffix(".png")
+                )
+                save_to.parent.mkdir(exist_ok=True, parents=True)
+                vector.colorgram.save(save_to)
+                if distribution_sidecars:
+                    save_distributions(
+                        vector, save_to.parents[1].joinpath("colorgrams-distributions"), metadata["s3_key"]
                     )
-                    save_to.parent.mkdir(exist_ok=True, parents=True)
-                    vector.colorgram.save(save_to)
-            if len(documents) > 1:
-                log.warning(f"multiple vectors created from a single search run")
-            if not skip_mturk_colorgrams:
-                raise UnimplementedError(f"Must implement Mturk task creation from colorgram documents")
-
-            index_to_elasticsearch(
-                elasticsearch_client=elasticsearch_client,
-                index=COLORGRAMS_INDEX_PATTERN,
-                docs=documents,
-                identity_fields=["experiment_name", "downloads", "s3_key"],
-                overwrite=False,
+        if len(search.colorgram_documents) > 1:
+            log.warning(f"multiple vectors created from a single search run")
+        search.colorgram_documents_file.write_text(json.dumps(search.colorgram_documents))
+        finished(search, "vectors")
+        return search
+
+    def index(search: TrialSearch) -> None:
+        # documents refer to images in S3, so their uploads must finish first
+        uploader.flush(search.uploads)
+        finished(search, "uploads")
+
+        indexing = list()
+        if not skip_face_detection:
+            indexing.append(
+                dict(
+                    index=CROPPED_FACE_INDEX_PATTERN,
+                    docs=search.face_documents,
+                    identity_fields=["face_id", "query"], # this makes it so that we only store each cropped face in elasticsearch once for the query that returned it.
+                    overwrite=False,
+                )
+            )
+        indexing.append(
+            dict(
+                index=RAW_IMAGES_INDEX_PATTERN,
+                docs=json.loads(search.manifest.read_text()),
+                identity_fields=["trial_id", "trial_hostname", "ran_at"],
+            )
+        )
+        if not skip_vectors:
+            indexing.append(
+                dict(
+                    index=COLORGRAMS_INDEX_PATTERN,
+                    docs=search.colorgram_documents,
+                    identity_fields=["experiment_name", "downloads", "s3_key"],
+                    overwrite=False,
+                )
             )
+
+        # every index is attempted, but the search only counts as indexed if none of them had failures,
+        # otherwise --skip-already-searched would never retry it
+        failures = list()
+        for kwargs in indexing:
+            try:
+                index_to_elasticsearch(elasticsearch_client=elasticsearch_client, **kwargs)
+            except BulkIndexingError as exc:
+                failures.append(str(exc))
+        if len(failures) > 0:
+            raise BulkIndexingError("; ".join(failures))
+
+        if not skip_vectors:
             log.info(
-                f"vector for '{search_term}' indexed and saved to s3"
+                f"vector for '{search.search_term}' indexed and saved to s3"
                 + (
-                    f", and also here: {trial_downloads.with_suffix('.png')}"
+                    f", and also here: {search.query_downloads.joinpath('colorgrams')}"
                     if not no_local_data
                     else ""
                 )
             )
 
+        finished(search, "index")
 
         if no_local_data:
-            shutil.rmtree(query_downloads)
-            log.info(f"removed '{search_term}' data from local storage")
+            shutil.rmtree(search.data_root)
+            log.info(f"removed '{search.search_term}' data from local storage")
+
+    # the face extractor's worker processes are forked first, before the uploader and pipeline start any threads
+    face_extraction = (
+        FaceExtractor(
+            workers=face_processes,
+            cv2_cascade_min_neighbors=cv2_cascade_min_neighbors,
+            encode=True,
+            # shared by every trial on this host, so images that come back for other queries and trials skip detection
+            detection_cache_path=local_data_store.joinpath("face-detections.sqlite"),
+            detection_scale=face_detection_scale if face_detection_scale is not None else FACE_DETECTION_SCALE,
+        )
+        if not skip_face_detection
+        else contextlib.nullcontext()
+    )
+    with face_extraction as face_extractor, S3Uploader(
+        s3_client, bucket=s3_bucket_name, workers=upload_workers
+    ) as uploader:
+        errors = run_pipeline(
+            searches(),
+            stages=[
+                # query runners spend most of their time waiting on a browser, so several can be in flight
+                Stage("scrape", scrape, workers=parallel_queries),
+                Stage("faces", faces, workers=face_detection_workers),
+                Stage("vectors", vectors, workers=vector_workers),
+                Stage("index", index, workers=index_workers),
+            ],
+            queue_size=pipeline_queue_size,
+            describe=lambda search: f"'{search.search_term}'",
+        )
+
+    failures = search_failures(errors)
+    if len(failures) > 0:
+        log.error(
+            f"{len(failures)} searches did not complete: {', '.join(failures.keys())}"
+        )
+    return failures
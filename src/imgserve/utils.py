@@ -1,5 +1,8 @@
 from __future__ import annotations
+import errno
 import io
+import os
+import shutil
 from copy import copy
 
 import requests
@@ -19,6 +22,66 @@ def download_image(url: str, path: Path, overwrite: bool = False) -> None:
         f.write(resp.content)
 
 
+LINK_STRATEGIES = ["hardlink", "symlink", "reflink", "copy"]
+
+# ioctl request number to clone a file's extents on Linux (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def _reflink(source: Path, destination: Path) -> None:
+    import fcntl
+
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            destination.unlink()
+            raise
+
+
+def link_file(source: Path, destination: Path, strategy: str = "hardlink") -> str:
+    """
+        Place source at destination without rewriting its bytes where the filesystem allows it.
+        hardlink and reflink fall back to a copy when they are not possible, e.g. across filesystems.
+        Returns the strategy that was actually used.
+    """
+    if strategy not in LINK_STRATEGIES:
+        raise ValueError(f"{strategy} is not one of {LINK_STRATEGIES}")
+
+    try:
+        destination.unlink()
+    except FileNotFoundError:
+        pass
+
+    if strategy == "symlink":
+        destination.symlink_to(source.resolve())
+        return strategy
+
+    try:
+        if strategy == "hardlink":
+            os.link(source, destination)
+            return strategy
+        if strategy == "reflink":
+            _reflink(source, destination)
+            return strategy
+    except (AttributeError, ImportError, NotImplementedError):
+        pass
+    except OSError as exc:
+        if exc.errno not in (
+            errno.EXDEV,
+            errno.EPERM,
+            errno.EMLINK,
+            errno.EOPNOTSUPP,
+            errno.ENOTTY,
+            errno.EINVAL,
+        ):
+            raise
+
+    shutil.copyfile(source, destination)
+    return "copy"
+
+
 def get_batch_slice(items: List[Any], batch_slice: str) -> List[Any]:
     if " of " not in batch_slice and "/" not in batch_slice:
         raise InvalidSliceArgumentError(
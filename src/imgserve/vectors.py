@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
 import numpy as np
@@ -17,46 +20,171 @@ def tags_to_hash(tags: List[str]) -> str:
     return m.hexdigest()
 
 
-def array_to_list(array: numpy.ndarray) -> List[float]:
-    out = list()
-    for elem in array:
-        if np.isnan(elem):
-            out.append(None)
+# distribution arrays of a Vector, stored in colorgram documents as lists, and in .npz sidecars as arrays
+DISTRIBUTION_FIELDS = ["rgb_dist", "jzazbz_dist", "rgb_dist_std", "jzazbz_dist_std"]
+
+
+def array_to_list(array: numpy.ndarray) -> List[Optional[float]]:
+    """ JSON friendly copy of array, with NaN as None """
+    array = np.asarray(array, dtype=float)
+    out = array.astype(object)
+    out[np.isnan(array)] = None
+    return out.tolist()
+
+
+def list_to_array(values: List[Optional[float]]) -> numpy.ndarray:
+    """ inverse of array_to_list, None becomes NaN """
+    return np.array(values, dtype=float)
+
+
+def vector_distributions(vector: Vector) -> Dict[str, numpy.ndarray]:
+    distributions = dict()
+    for field in DISTRIBUTION_FIELDS:
+        try:
+            distributions[field] = np.asarray(getattr(vector, field), dtype=float)
+        except AttributeError:
+            pass
+    return distributions
+
+
+def save_distributions(vector: Vector, directory: Path, s3_key: str) -> Path:
+    """ write the distributions of vector to a <s3_key>.npz sidecar in directory """
+    directory.mkdir(exist_ok=True, parents=True)
+    sidecar = directory.joinpath(s3_key).with_suffix(".npz")
+    np.savez(sidecar, **vector_distributions(vector))
+    return sidecar
+
+
+def load_distributions(sidecar: Path) -> Dict[str, numpy.ndarray]:
+    with np.load(sidecar) as npz:
+        return {field: npz[field] for field in npz.files}
+
+
+def export_distributions(
+    colorgram_documents: Iterable[Dict[str, Any]], path: Path, sidecars: Optional[Path] = None
+) -> int:
+    """
+        Write the distributions of many colorgram documents to one .npz, one row per document, for bulk consumers.
+        Besides one 2D array per distribution field, the file has s3_key, and metadata holding the rest of each document as JSON.
+        Distributions are read from the <s3_key>.npz sidecar of a document in sidecars when there is one, rather than from its lists.
+        Returns the number of documents written.
+    """
+    s3_keys = list()
+    metadata = list()
+    distributions = {field: list() for field in DISTRIBUTION_FIELDS}
+    for document in colorgram_documents:
+        s3_keys.append(document["s3_key"])
+        metadata.append(
+            json.dumps({key: value for key, value in document.items() if key not in DISTRIBUTION_FIELDS})
+        )
+        sidecar = sidecars.joinpath(document["s3_key"]).with_suffix(".npz") if sidecars is not None else None
+        if sidecar is not None and sidecar.is_file():
+            arrays = load_distributions(sidecar)
         else:
-            out.append(elem)
-    return out
+            arrays = {
+                field: list_to_array(document[field])
+                for field in DISTRIBUTION_FIELDS
+                if document.get(field) is not None
+            }
+        for field in DISTRIBUTION_FIELDS:
+            distributions[field].append(arrays.get(field))
+
+    arrays = {
+        field: np.stack(rows)
+        for field, rows in distributions.items()
+        # vectors do not always have the std fields, only export fields every document has
+        if len(rows) > 0 and all(row is not None for row in rows)
+    }
+    path.parent.mkdir(exist_ok=True, parents=True)
+    np.savez(path, s3_key=np.array(s3_keys), metadata=np.array(metadata), **arrays)
+    return len(s3_keys)
+
+
+def folder_vector(folder: Path) -> Optional[Tuple[Vector, Dict[str, Any]]]:
+    """ Vector of the images in one downloads folder, and its metadata, or None if the folder name is not made of key=value tags """
+    if len(list(folder.iterdir())) == 0:
+        raise NoDownloadsError(f"No downloaded images available at {folder}")
+    vector = Vector(folder.name).load_from_folder(folder.parent)
+    metadata = vector_metadata(folder, vector)
+    if metadata is None:
+        return None
+    return vector, metadata
+
+
+def vector_metadata(folder: Path, vector: Vector) -> Optional[Dict[str, Any]]:
+    """ colorgram document of the vector made from the images in folder, None if the folder name is not made of key=value tags """
+    log = simple_logger("get_vectors")
+    tags = str(folder.name).split("|")
+    try:
+        metadata = {key: value for key, value in (tag.split("=") for tag in tags)}
+    except ValueError as e:
+        log.error(f"Couldn't load metadata from colorgram stem: {tags}")
+        return None
+    metadata.update(
+        {
+            "downloads": [img.stem for img in folder.iterdir()],
+            "s3_key": tags_to_hash(tags),
+            "rgb_dist": array_to_list(vector.rgb_dist),
+            "jzazbz_dist": array_to_list(vector.jzazbz_dist),
+        }
+    )
+    try:
+        metadata.update(rgb_dist_std=array_to_list(vector.rgb_dist_std))
+    except AttributeError:
+        pass
+
+    try:
+        metadata.update(jzazbz_dist_std=array_to_list(vector.jzazbz_dist_std))
+    except AttributeError:
+        pass
+
+    return metadata
 
 
 def get_vectors(
     downloads_path: Path,
 ) -> Generator[Tuple[Vector, Dict[str, Any]], None, None]:
-    log = simple_logger("get_vectors")
     for folder in downloads_path.iterdir():
-        if len(list(folder.iterdir())) == 0:
-            raise NoDownloadsError(f"No downloaded images available at {folder}")
-        vector = Vector(folder.name).load_from_folder(folder.parent)
-        tags = str(folder.name).split("|")
-        try:
-            metadata = {key: value for key, value in (tag.split("=") for tag in tags)}
-        except ValueError as e:
-            log.error(f"Couldn't load metadata from colorgram stem: {tags}")
-            continue
-        metadata.update(
-            {
-                "downloads": [img.stem for img in folder.iterdir()],
-                "s3_key": tags_to_hash(tags),
-                "rgb_dist": array_to_list(vector.rgb_dist),
-                "jzazbz_dist": array_to_list(vector.jzazbz_dist),
-            }
-        )
-        try:
-            metadata.update(rgb_dist_std=array_to_list(vector.rgb_dist_std))
-        except AttributeError:
-            pass
+        result = folder_vector(folder)
+        if result is not None:
+            yield result
 
-        try:
-            metadata.update(jzazbz_dist_std=array_to_list(vector.jzazbz_dist_std))
-        except AttributeError:
-            pass
 
-        yield vector, metadata
+def get_vectors_concurrently(
+    downloads_path: Path,
+    workers: Optional[int] = None,
+    max_in_flight: Optional[int] = None,
+    errors: Optional[Dict[str, str]] = None,
+) -> Generator[Tuple[Vector, Dict[str, Any]], None, None]:
+    """
+        Like get_vectors, with each folder loaded in a pool of worker processes, yielding vectors as their folders finish.
+        At most max_in_flight folders (default: twice the workers) are loaded or waiting to be consumed at once, to cap memory.
+        A folder that fails, e.g. with NoDownloadsError, is recorded in errors by folder name instead of stopping the others.
+    """
+    log = simple_logger("get_vectors")
+    workers = workers if workers is not None else os.cpu_count()
+    max_in_flight = max_in_flight if max_in_flight is not None else workers * 2
+    errors = errors if errors is not None else dict()
+    in_flight = dict()
+
+    def collect(futures: Set[Future]) -> Generator[Tuple[Vector, Dict[str, Any]], None, None]:
+        for future in futures:
+            folder = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as exc:
+                log.error(f"could not create a vector from {folder}: {exc!r}")
+                errors[folder.name] = repr(exc)
+                continue
+            if result is not None:
+                yield result
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for folder in downloads_path.iterdir():
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+            in_flight[executor.submit(folder_vector, folder)] = folder
+        while len(in_flight) > 0:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            yield from collect(done)
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import shutil
+
+import numpy as np
+
+from imgserve.distributions import DistributionStore, combine, get_combined_vectors
+from imgserve.vectors import DISTRIBUTION_FIELDS, get_vectors
+
+FACES = Path(__file__).parent.joinpath("faces")
+
+
+def test_distribution_store(tmp_path: Path) -> None:
+    store = DistributionStore(tmp_path.joinpath("store"))
+    rng = np.random.default_rng(0)
+    images = {
+        f"image-{i}": {
+            "rgb_dist": rng.random(8),
+            "jzazbz_dist": rng.random(8),
+            "colorgram": rng.integers(0, 255, (4, 4, 3), dtype=np.uint8),
+        }
+        for i in range(3)
+    }
+    for image_sha256, arrays in images.items():
+        store.add(image_sha256, arrays)
+    # adding an image twice keeps its first row
+    assert store.add("image-0", images["image-0"]) == 0
+    store.close()
+
+    # rows survive reopening the store
+    store = DistributionStore(tmp_path.joinpath("store"))
+    assert len(store) == 3
+    vector = combine(store, ["image-0", "image-2", "unknown"], word="test")
+    assert np.allclose(
+        vector.jzazbz_dist, np.mean([images["image-0"]["jzazbz_dist"], images["image-2"]["jzazbz_dist"]], axis=0)
+    )
+    assert np.allclose(
+        vector.rgb_dist_std, np.std([images["image-0"]["rgb_dist"], images["image-2"]["rgb_dist"]], axis=0)
+    )
+    assert vector.colorgram.size == (4, 4)
+
+    # an image in the group twice counts twice, as two copies of it in a folder do for compsyn
+    vector = combine(store, ["image-0", "image-0", "image-1"], word="test")
+    assert np.allclose(
+        vector.rgb_dist,
+        np.mean([images["image-0"]["rgb_dist"], images["image-0"]["rgb_dist"], images["image-1"]["rgb_dist"]], axis=0),
+    )
+
+
+def test_combine_matches_get_vectors(tmp_path: Path) -> None:
+    # combined vectors are indexed alongside vectors compsyn made from the whole folder, they must agree
+    downloads = tmp_path.joinpath("downloads")
+    folder = downloads.joinpath("query=faces")
+    folder.mkdir(parents=True)
+    for image in sorted(FACES.glob("*.jpg"))[:5]:
+        shutil.copy(image, folder.joinpath(image.name))
+
+    vector, metadata = next(get_vectors(downloads))
+    store = DistributionStore(tmp_path.joinpath("store"))
+    combined_vector, combined_metadata = next(get_combined_vectors(downloads, store, workers=1))
+
+    # combined documents never share an s3_key with the exact colorgram of the same folder
+    assert combined_metadata["s3_key"] != metadata["s3_key"]
+    assert combined_metadata["vector_aggregation"] == "image_mean"
+    assert sorted(combined_metadata["downloads"]) == sorted(metadata["downloads"])
+    for field in DISTRIBUTION_FIELDS:
+        if hasattr(vector, field):
+            assert np.allclose(
+                getattr(combined_vector, field), np.asarray(getattr(vector, field), dtype=np.float64), atol=1e-9
+            ), field
+    assert np.array_equal(np.asarray(combined_vector.colorgram), np.asarray(vector.colorgram))
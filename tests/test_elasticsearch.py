@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import elasticsearch
+import pytest
+import retry.api
+
+from imgserve.elasticsearch import chunk_actions, index_to_elasticsearch
+from imgserve.errors import BulkIndexingError
+
+
+def test_chunk_actions() -> None:
+    actions = ({"_index": "test", "n": n} for n in range(1203))
+    chunks = list(chunk_actions(actions, chunk_size=500))
+    assert [len(chunk) for chunk in chunks] == [500, 500, 203]
+    assert [action["n"] for chunk in chunks for action in chunk] == list(range(1203))
+    assert list(chunk_actions(iter([]), chunk_size=500)) == []
+
+
+def test_failed_chunk_retried_then_raised(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(retry.api.time, "sleep", lambda seconds: None)
+    requests = list()
+
+    # every request holding the document "bad" fails to connect, the others succeed
+    def bulk(client, actions, **kwargs):
+        actions = list(actions)
+        requests.append([action["n"] for action in actions])
+        if any(action["n"] == "bad" for action in actions):
+            raise elasticsearch.exceptions.ConnectionError("N/A", "connection refused", None)
+        return len(actions), list()
+
+    monkeypatch.setattr(elasticsearch.helpers, "bulk", bulk)
+
+    with pytest.raises(BulkIndexingError):
+        index_to_elasticsearch(
+            elasticsearch_client=None,
+            index="test",
+            docs=[{"n": 1}, {"n": 2}, {"n": "bad"}, {"n": 3}, {"n": 4}],
+            batch_size=2,
+            workers=1,
+            quiet=True,
+        )
+
+    # only the failing chunk is sent again, once per try, chunks that were indexed are not
+    assert requests == [[1, 2], ["bad", 3], ["bad", 3], ["bad", 3], [4]]
@@ -2,9 +2,10 @@ from __future__ import annotations
 
 from pathlib import Path
 
+import cv2
 import pytest
 
-from imgserve.faces import facechop
+from imgserve.faces import FACE_CLASSIFIER, FACE_DETECTION_SCALE, DetectionCache, detect_faces, facechop, facechop_many
 
 def test_facechop() -> None:
     successes = list()
@@ -32,3 +33,47 @@ def test_facechop() -> None:
     print("successes:", len(successes))
     print("failures:", len(failures))
     assert len(failures) == 0, "\n".join(failures)
+
+
+def test_facechop_many(tmp_path: Path) -> None:
+    test_imgs = sorted(Path(__file__).parent.joinpath("faces").glob("*.jpg"))
+    extractions = list(
+        facechop_many(
+            ((test_img, tmp_path.joinpath(test_img.stem)) for test_img in test_imgs),
+            workers=2,
+        )
+    )
+    # results stream back in input order, with the same faces facechop finds on its own
+    assert [extraction.image for extraction in extractions] == test_imgs
+    for extraction in extractions:
+        assert extraction.error is None
+        assert len(extraction.faces) == len(
+            list(facechop(extraction.image, tmp_path.joinpath("sequential")))
+        )
+
+
+def test_facechop_encode(tmp_path: Path) -> None:
+    for test_img in Path(__file__).parent.joinpath("faces").glob("*.jpg"):
+        written = list(facechop(test_img, tmp_path.joinpath(test_img.stem)))
+        encoded = list(facechop(test_img, output_dir=None, encode=True))
+        assert len(encoded) == len(written)
+        for face_crop in encoded:
+            assert face_crop.path is None
+            assert face_crop.jpeg[:2] == b"\xff\xd8"
+            assert face_crop.bounding_box["width"] > 0
+
+
+def test_detection_cache(tmp_path: Path) -> None:
+    detection_cache = DetectionCache(tmp_path.joinpath("detections.sqlite"))
+    for test_img in Path(__file__).parent.joinpath("faces").glob("*.jpg"):
+        detected = list(facechop(test_img, tmp_path.joinpath("detected"), detection_cache=detection_cache))
+        # without a classifier, the second run can only be answered by the cache
+        cached = list(facechop(test_img, tmp_path.joinpath("cached"), face_classifier=None, detection_cache=detection_cache))
+        assert [path.name for path in cached] == [path.name for path in detected]
+
+
+def test_default_scale_matches_full_size_detection() -> None:
+    for test_img in Path(__file__).parent.joinpath("faces").glob("*.jpg"):
+        img = cv2.imread(str(test_img))
+        full_size = [tuple(int(v) for v in f) for f in FACE_CLASSIFIER.detectMultiScale(img, minNeighbors=5)]
+        assert sorted(detect_faces(img, FACE_CLASSIFIER, 5, FACE_DETECTION_SCALE)) == sorted(full_size), test_img.name
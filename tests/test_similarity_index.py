@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+
+from imgserve.similarity import SimilarityIndex, js_divergence, normalize
+
+
+def test_js_divergence() -> None:
+    p = normalize(np.array([[1.0, 0.0], [0.5, 0.5]]))
+    distances = js_divergence(p, normalize(np.array([[1.0, 0.0], [0.0, 1.0]])))
+    assert np.allclose(distances[0], [0.0, 1.0])
+    assert np.allclose(distances[1, 0], distances[1, 1])
+
+
+def test_similar_words(tmp_path: Path) -> None:
+    similarity_index = SimilarityIndex(
+        words=["red", "crimson", "blue", "navy"],
+        s3_keys=["a", "b", "c", "d"],
+        distributions=np.array(
+            [[9.0, 1.0, 0.0], [8.0, 2.0, np.nan], [0.0, 1.0, 9.0], [0.0, 2.0, 8.0]]
+        ),
+        colorgrams=5,
+    )
+    similarity_index.save(tmp_path.joinpath("index.npz"))
+    similarity_index = SimilarityIndex.load(tmp_path.joinpath("index.npz"))
+    # the colorgram count the index was built from survives saving, to tell when it is stale
+    assert similarity_index.colorgrams == 5
+
+    for metric in ["js", "cosine"]:
+        similar = similarity_index.similar_words("red", k=2, metric=metric)[0]["similar"]
+        assert [neighbour["word"] for neighbour in similar] == ["crimson", "navy"]
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+from imgserve.journal import TrialJournal
+from imgserve.pipeline import Stage, run_pipeline
+from imgserve.trial import TrialSearch, run_query, search_failures
+
+# stands in for the query runner container: creates an empty manifest where qloader would, the term "slow" never finishes
+STUB_QUERY_RUNNER_COMMAND = (
+    "sh -c '"
+    'if [ "{search_term}" = slow ]; then sleep 30; fi; '
+    "sleep 1; "
+    "mkdir -p {data_root}/{trial_id}/{hostname}/{trial_timestamp} && "
+    "echo [] > {data_root}/{trial_id}/{hostname}/{trial_timestamp}/manifest.json"
+    "'"
+)
+
+
+def make_search(local_data_store: Path, search_term: str) -> TrialSearch:
+    return TrialSearch(
+        search_term=search_term,
+        trial_id="test-trial",
+        trial_hostname="test-host",
+        trial_timestamp="2020-01-01T00:00:00Z",
+        image_document_shared={"query": search_term},
+        data_root=local_data_store.joinpath(search_term),
+    )
+
+
+def test_parallel_queries(tmp_path: Path) -> None:
+    search_terms = ["cat", "dog", "slow", "bird"]
+    completed = list()
+
+    start = time.time()
+    errors = run_pipeline(
+        (make_search(tmp_path, search_term) for search_term in search_terms),
+        stages=[
+            Stage(
+                "scrape",
+                lambda search: run_query(
+                    search, query_runner_command=STUB_QUERY_RUNNER_COMMAND, timeout=3
+                ),
+                workers=len(search_terms),
+            ),
+            Stage("done", lambda search: completed.append(search.search_term)),
+        ],
+    )
+    elapsed = time.time() - start
+
+    assert sorted(completed) == ["bird", "cat", "dog"]
+    assert len(errors) == 1
+    assert errors[0].item.search_term == "slow"
+    assert isinstance(errors[0].exception, subprocess.TimeoutExpired)
+    # every query runner was in flight at once, so the run takes about as long as the timeout
+    assert elapsed < 6
+
+    for search_term in completed:
+        search = make_search(tmp_path, search_term)
+        assert search.manifest.is_file()
+        assert search.metadata_log.is_file()
+
+
+def test_timed_out_query_fails(tmp_path: Path) -> None:
+    errors = run_pipeline(
+        (make_search(tmp_path, search_term) for search_term in ["cat", "slow"]),
+        stages=[
+            Stage(
+                "scrape",
+                lambda search: run_query(
+                    search, query_runner_command=STUB_QUERY_RUNNER_COMMAND, timeout=3
+                ),
+                workers=2,
+            ),
+        ],
+    )
+
+    # run_trial returns these, and bin/experiment.py exits non-zero when there are any, so the batch loop runs the trial again
+    failures = search_failures(errors)
+    assert list(failures.keys()) == ["slow"]
+    assert failures["slow"].startswith("scrape: TimeoutExpired")
+
+
+def test_journal_resume(tmp_path: Path) -> None:
+    journal_path = tmp_path.joinpath("journal.jsonl")
+    journal = TrialJournal(journal_path)
+    search = make_search(tmp_path, "cat")
+    for stage in ["scrape", "faces"]:
+        journal.record(
+            trial_id=search.trial_id,
+            hostname=search.trial_hostname,
+            search_term=search.search_term,
+            trial_timestamp=search.trial_timestamp,
+            data_root=search.data_root,
+            stage=stage,
+        )
+    # a crash can leave the last line cut short
+    with open(journal_path, "a") as f:
+        f.write('{"trial_id": "test-tr')
+
+    progress = TrialJournal(journal_path).get("test-trial", "test-host", "cat")
+    assert progress.stages == {"scrape", "faces"}
+    assert progress.trial_timestamp == search.trial_timestamp
+    assert progress.data_root == search.data_root
+    assert TrialJournal(journal_path).get("test-trial", "test-host", "dog") is None